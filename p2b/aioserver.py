@@ -0,0 +1,93 @@
+# asyncio runtime of the node (server.py --runtime asyncio): one aiohttp event loop accepts and parses every
+# connection, and hands each request to the routes of the Flask app through WSGI. Requests that change the node
+# (anything but GET) run one at a time on a dedicated worker thread, reads on a small pool. Responses stream back
+# through the loop chunk by chunk, each chunk produced on the same pool as the request.
+import io
+import sys
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from aiohttp import web
+
+# connection level headers, aiohttp sets its own
+HOP_BY_HOP = {'connection', 'keep-alive', 'transfer-encoding', 'upgrade'}
+
+
+class WSGIBridge(object):
+    def __init__(self, app, readers=4):
+        self.app = app  # WSGI application
+        self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='writer')
+        self.readers = ThreadPoolExecutor(max_workers=readers, thread_name_prefix='reader')
+
+    @staticmethod
+    def environ(request, body, port):
+        environ = {
+            'REQUEST_METHOD': request.method,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': request.path.encode('utf-8').decode('latin-1'),
+            'QUERY_STRING': request.query_string,
+            'SERVER_NAME': 'localhost',
+            'SERVER_PORT': str(port),
+            'SERVER_PROTOCOL': 'HTTP/%d.%d' % request.version,
+            'REMOTE_ADDR': request.remote or '',
+            'CONTENT_TYPE': request.headers.get('Content-Type', ''),
+            'CONTENT_LENGTH': str(len(body)),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.input': io.BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        for name, value in request.headers.items():
+            key = 'HTTP_' + name.upper().replace('-', '_')
+            if key not in ('HTTP_CONTENT_TYPE', 'HTTP_CONTENT_LENGTH'):
+                environ[key] = value if key not in environ else environ[key] + ',' + value
+        return environ
+
+    # runs the app on a worker thread. Returns (status, headers, first chunk, rest of the body, body to close)
+    def call(self, environ):
+        started = []
+
+        def start_response(status, headers, exc_info=None):
+            started[:] = [status, headers]
+
+        body = self.app(environ, start_response)
+        iterator = iter(body)
+        first = next(iterator, b'')  # runs the handler up to its first chunk, the status is known after that
+        return started[0], started[1], first, iterator, body
+
+    async def handle(self, request):
+        body = await request.read()
+        environ = self.environ(request, body, request.url.port)
+        executor = self.readers if request.method == 'GET' else self.writer
+        loop = asyncio.get_running_loop()
+        status, headers, first, iterator, closable = await loop.run_in_executor(executor, self.call, environ)
+        try:
+            response = web.StreamResponse(status=int(status.split(' ', 1)[0]), reason=status.split(' ', 1)[1])
+            for name, value in headers:
+                if name.lower() not in HOP_BY_HOP:
+                    response.headers.add(name, value)
+            await response.prepare(request)
+            await response.write(first)
+            # the rest of the body is produced on the worker too: streamed routes encode while they yield
+            while True:
+                chunk = await loop.run_in_executor(executor, next, iterator, None)
+                if chunk is None:
+                    break
+                await response.write(chunk)
+            await response.write_eof()
+            return response
+        finally:
+            if hasattr(closable, 'close'):
+                closable.close()
+
+
+def run(app, port, host='0.0.0.0'):
+    bridge = WSGIBridge(app)
+    server = web.Application(client_max_size=1024 ** 3)
+    server.router.add_route('*', '/{path:.*}', bridge.handle)
+    logging.info("[RUNTIME] asyncio runtime listening on %s:%d" % (host, port))
+    web.run_app(server, host=host, port=port, print=None, access_log=None)
@@ -0,0 +1,287 @@
+# Micro-benchmarks for the node internals. Run from this directory, e.g. `python3 bench.py wire -n 5000`.
+import sys
+import itertools
+import json
+import time
+import shutil
+import tempfile
+import subprocess
+import random
+import logging
+import tracemalloc
+
+import requests
+
+import blockchain as bc
+from storage import BlockLog
+
+
+def sample_block(txns, accounts):
+    names = ['account-%d' % i for i in range(accounts)]
+    rng = random.Random(639)
+    transactions = [bc.Transaction(rng.choice(names), rng.choice(names), rng.randint(1, 10000)) for _ in range(txns)]
+    return bc.Block(2, transactions, '0x' + '0' * 64, 5001)
+
+
+# runs fn `repeat` times, returns the best time in seconds
+def best_of(repeat, fn):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def bench_wire(args):
+    block = sample_block(args.txns, args.accounts)
+    jsonBody = json.dumps(block.encode()).encode('utf-8')
+    binaryBody = block.encode_binary()
+
+    formats = [
+        ('json', jsonBody, lambda: json.dumps(block.encode()).encode('utf-8'), lambda: bc.Block.decode(json.loads(jsonBody))),
+        ('binary', binaryBody, lambda: block.encode_binary(), lambda: bc.Block.decode_binary(binaryBody)),
+    ]
+    print("block with %d transactions over %d accounts, best of %d" % (args.txns, args.accounts, args.repeat))
+    print("%-8s %12s %16s %16s" % ('format', 'bytes', 'encode txns/s', 'decode txns/s'))
+    for name, body, encode, decode in formats:
+        encodeTime = best_of(args.repeat, encode)
+        decodeTime = best_of(args.repeat, decode)
+        print("%-8s %12d %16.0f %16.0f" % (name, len(body), args.txns / encodeTime, args.txns / decodeTime))
+
+
+# bytes allocated by build() and still referenced by what it returns
+def allocated(build):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = build()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+    return after - before
+
+
+def bench_memory(args):
+    names = ['account-%d' % i for i in range(args.accounts)]
+    rng = random.Random(639)
+    histories = [[(1000 + 7 * j, rng.randint(1000, 10 ** 6)) for j in range(args.history)] for _ in names]
+
+    # the layout before account interning: {"account-id": <amount>} and {"account": [[block #, amount]]}
+    def dicts():
+        account = {}
+        historyList = {}
+        for name, entries in zip(names, histories):
+            account[name] = sum(amount for _, amount in entries)
+            historyList[name] = [[number, amount] for number, amount in entries]
+        return account, historyList
+
+    def interned():
+        return bc.State.restore({
+            'account': [[name, sum(amount for _, amount in entries)] for name, entries in zip(names, histories)],
+            'history': [[name, entries] for name, entries in zip(names, histories)],
+        })
+
+    print("%d accounts with %d history entries each (account names are shared by both layouts and not counted)" % (args.accounts, args.history))
+    print("%-10s %14s %18s" % ('layout', 'bytes', 'bytes per account'))
+    for name, build in [('dict', dicts), ('interned', interned)]:
+        size = allocated(build)
+        print("%-10s %14d %18.1f" % (name, size, size / args.accounts))
+
+
+# A valid chain of `blocks` blocks mined round robin by `nodes`: after the genesis block, A funds `txns` accounts
+# and from then on every block passes one coin around that ring of accounts.
+def sample_chain(blocks, txns, nodes):
+    names = ['account-%d' % i for i in range(txns)]
+    chain = [bc.Block(1, [], '0xfeedcafe', nodes[0])]
+    for number in range(2, blocks + 1):
+        if number == 2:
+            transactions = [bc.Transaction('A', name, 1) for name in names]
+        else:
+            transactions = [bc.Transaction(names[i], names[(i + 1) % txns], 1) for i in range(txns)]
+        chain.append(bc.Block(number, transactions, chain[-1].hash, nodes[(number - 1) % len(nodes)]))
+    return chain
+
+
+# a node of the cluster `ports` in its own process
+def start_node(port, ports, *options):
+    args = [sys.executable, 'server.py', '-p', str(port), '-n'] + [str(p) for p in ports] + list(options)
+    return subprocess.Popen(args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+# polls `check` until it returns true, connection errors count as false
+def wait_for(check, timeout=60, message="timed out"):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            if check():
+                return
+        except requests.RequestException:
+            pass
+        if time.monotonic() > deadline:
+            raise RuntimeError(message)
+        time.sleep(0.05)
+
+
+# Catch-up throughput: a node serving a recovered chain from its block log, and an empty in-process node syncing from it.
+def bench_sync(args):
+    source, target = args.port, args.port + 1
+    datadir = tempfile.mkdtemp(prefix='p2b-bench-')
+    server = None
+    try:
+        log = BlockLog(datadir)
+        for block in sample_chain(args.blocks, args.txns, [source, target]):
+            log.append(block.encode_record(), durable=False)
+        log.close()
+
+        server = start_node(source, [source, target], '--datadir', datadir, '--snapshot-blocks', '0', '--snapshot-interval', '0')
+        wait_for(lambda: requests.get('http://localhost:%d/health' % source, timeout=1).ok, message="source node did not come up")
+
+        print("%d blocks with %d transactions each" % (args.blocks, args.txns))
+        print("%-8s %10s %14s %14s" % ('batch', 'seconds', 'blocks/s', 'txns/s'))
+        for batch in args.batch:
+            node = bc.Blockchain()
+            node.nodes = [source, target]
+            node.node_identifier = target
+            node.sync_batch_blocks = batch
+            started = time.perf_counter()
+            applied = node.catch_up([source])
+            elapsed = time.perf_counter() - started
+            if applied != args.blocks:
+                raise RuntimeError("caught up %d of %d blocks" % (applied, args.blocks))
+            print("%-8d %10.3f %14.0f %14.0f" % (batch, elapsed, applied / elapsed, applied * args.txns / elapsed))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+        shutil.rmtree(datadir)
+
+
+# Submit-to-commit latency: transactions are submitted to random nodes of a local cluster, and each is polled
+# on the node it was submitted to until that node has committed it. Also reports how fast the chain advanced.
+def bench_latency(args):
+    rng = random.Random(639)
+    print("%-6s %-6s %-6s %10s %10s %10s %10s" % ('nodes', 'relay', 'depth', 'mean s', 'p50 s', 'max s', 'blocks/s'))
+    for nodes, relay, depth in itertools.product(args.nodes, args.relay, args.pipeline):
+        ports = [args.port + i for i in range(nodes)]
+        servers = [start_node(port, ports, '-t', str(args.blocktime), '--relay', str(relay), '--pipeline-depth', str(depth)) for port in ports]
+        try:
+            for port in ports:
+                wait_for(lambda: requests.get('http://localhost:%d/health' % port, timeout=1).ok, message="node %d did not come up" % port)
+            requests.get('http://localhost:%d/startexp/' % ports[0])
+            wait_for(lambda: len(requests.get('http://localhost:%d/blocks' % ports[-1]).json()['blocks']) > 0, message="no genesis block")
+            first = time.monotonic()
+
+            submitted = []  # [(port, txid, submitted at)]
+            for i in range(args.txns):
+                port = rng.choice(ports)
+                txn = {'sender': 'A', 'recipient': 'latency-%d' % i, 'amount': 1}
+                started = time.monotonic()
+                requests.post('http://localhost:%d/transactions/new' % port, json=txn)
+                submitted.append((port, bc.Transaction('A', txn['recipient'], 1).txid(), started))
+                time.sleep(args.gap)
+
+            latencies = {}
+            deadline = time.monotonic() + args.blocktime * nodes * 3 + 10
+            while len(latencies) < len(submitted) and time.monotonic() < deadline:
+                for port, txid, started in submitted:
+                    if txid not in latencies and requests.get('http://localhost:%d/tx/%s' % (port, txid)).json()['blocks']:
+                        latencies[txid] = time.monotonic() - started
+                time.sleep(0.02)
+            if len(latencies) < len(submitted):
+                raise RuntimeError("%d of %d transactions not committed" % (len(submitted) - len(latencies), len(submitted)))
+            values = sorted(latencies.values())
+            rate = (len(requests.get('http://localhost:%d/dump' % ports[0]).json()['chain']) - 1) / (time.monotonic() - first)
+            print("%-6d %-6d %-6d %10.2f %10.2f %10.2f %10.2f" % (nodes, relay, depth, sum(values) / len(values), values[len(values) // 2], values[-1], rate))
+        finally:
+            for server in servers:
+                server.terminate()
+                server.wait()
+
+
+# Requests/s of one node under `concurrency` concurrent keep-alive clients, per runtime and route.
+def bench_http(args):
+    import asyncio
+    import aiohttp
+
+    async def load(url, method, payload):
+        done = 0
+        deadline = time.monotonic() + args.duration
+
+        async def client(session):
+            nonlocal done
+            while time.monotonic() < deadline:
+                async with session.request(method, url, json=payload(done)) as response:
+                    await response.read()
+                    if response.status >= 400:
+                        raise RuntimeError("%s %s: %d" % (method, url, response.status))
+                done += 1
+
+        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=args.concurrency)) as session:
+            started = time.monotonic()
+            await asyncio.gather(*[client(session) for _ in range(args.concurrency)])
+            return done / (time.monotonic() - started)
+
+    routes = [
+        ('GET /health', 'GET', '/health', lambda i: None),
+        ('POST /transactions/new', 'POST', '/transactions/new', lambda i: {'sender': 'A', 'recipient': 'http-%d' % i, 'amount': 1}),
+        ('GET /balance', 'GET', '/balance?account=A', lambda i: None),
+    ]
+    print("%d concurrent clients, %.0fs per route" % (args.concurrency, args.duration))
+    print("%-10s %-24s %12s" % ('runtime', 'route', 'requests/s'))
+    for runtime in args.runtime:
+        server = start_node(args.port, [args.port], '--runtime', runtime)
+        try:
+            wait_for(lambda: requests.get('http://localhost:%d/health' % args.port, timeout=1).ok, message="node did not come up")
+            for name, method, path, payload in routes:
+                rate = asyncio.run(load('http://localhost:%d%s' % (args.port, path), method, payload))
+                print("%-10s %-24s %12.0f" % (runtime, name, rate))
+        finally:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    logging.getLogger().setLevel(logging.WARNING)
+
+    parser = ArgumentParser()
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    wire = subparsers.add_parser('wire', help='JSON vs binary block encode/decode throughput')
+    wire.add_argument('-n', '--txns', default=5000, type=int, help='transactions per block')
+    wire.add_argument('-a', '--accounts', default=1000, type=int, help='distinct accounts')
+    wire.add_argument('-r', '--repeat', default=5, type=int, help='repetitions, the best one is reported')
+    wire.set_defaults(run=bench_wire)
+
+    memory = subparsers.add_parser('memory', help='state memory: dicts of Python objects vs interned ids and typed arrays')
+    memory.add_argument('-a', '--accounts', default=200000, type=int, help='accounts')
+    memory.add_argument('-l', '--history', default=4, type=int, help='history entries per account')
+    memory.set_defaults(run=bench_memory)
+
+    sync = subparsers.add_parser('sync', help='catch-up sync throughput from a peer, in blocks/s')
+    sync.add_argument('-b', '--blocks', default=5000, type=int, help='blocks to catch up')
+    sync.add_argument('-n', '--txns', default=100, type=int, help='transactions per block (at most 10000)')
+    sync.add_argument('--batch', default=[1, 50, 500], type=int, nargs='+', help='blocks per request, one run each')
+    sync.add_argument('-p', '--port', default=5900, type=int, help='port of the serving node, the syncing node pretends to be the next one')
+    sync.set_defaults(run=bench_sync)
+
+    latency = subparsers.add_parser('latency', help='submit-to-commit latency of a local cluster, with and without transaction relay')
+    latency.add_argument('--nodes', default=[3, 5], type=int, nargs='+', help='cluster sizes, one run each')
+    latency.add_argument('--relay', default=[0, 2], type=int, nargs='+', help='upcoming proposers relayed to (0: off), one run each')
+    latency.add_argument('--pipeline', default=[1], type=int, nargs='+', help='pipeline depths of the nodes (1: off), one run each')
+    latency.add_argument('-n', '--txns', default=40, type=int, help='transactions submitted per run')
+    latency.add_argument('-g', '--gap', default=0.05, type=float, help='seconds between submissions')
+    latency.add_argument('-t', '--blocktime', default=1, type=int, help='block time of the nodes')
+    latency.add_argument('-p', '--port', default=5910, type=int, help='port of the first node')
+    latency.set_defaults(run=bench_latency)
+
+    http = subparsers.add_parser('http', help='requests/s of the Flask and asyncio runtimes (needs aiohttp)')
+    http.add_argument('--runtime', default=['flask', 'asyncio'], nargs='+', choices=['flask', 'asyncio'], help='runtimes, one run each')
+    http.add_argument('-c', '--concurrency', default=32, type=int, help='concurrent clients')
+    http.add_argument('-d', '--duration', default=5, type=float, help='seconds per route')
+    http.add_argument('-p', '--port', default=5930, type=int, help='port of the node')
+    http.set_defaults(run=bench_http)
+
+    args = parser.parse_args()
+    args.run(args)
@@ -1,14 +1,77 @@
 # forked from https://github.com/dvf/blockchain
 
+import bisect
+import collections
 import hashlib
+import itertools
 import json
+import struct
 import time
+import queue
 import threading
 import logging
 from array import *
+from concurrent.futures import Future
 
 import requests
 from flask import Flask, request
+from sortedcontainers import SortedKeyList
+
+from merkle import MerkleBuilder, leaf_hash, merkle_levels, inclusion_proof, verify_inclusion
+from storage import BlockLog, SnapshotStore
+from transport import PeerTransport
+from relay import TransactionRelay
+
+
+# Compact binary wire format, negotiated through the Content-Type header (JSON stays the fallback).
+# Scalars are tagged: b's' + u32 length + utf-8 bytes, or b'i' + i64.
+# Transaction: magic, sender, recipient, amount.
+# Block: magic, number, previous_hash, miner, hash, version, u32 count + account table (scalars), u32 count + (u32, u32, i64) records
+# of (sender index, recipient index, amount). Every account is written once per block.
+WIRE_CONTENT_TYPE = 'application/x-p2b-binary'
+WIRE_MAGIC = b'P2B\x01'
+_U32 = struct.Struct('<I')
+_I64 = struct.Struct('<q')
+_TXN_RECORD = struct.Struct('<IIq')
+
+# amounts and balances are stored as 64 bit integers
+INT64_MIN = -2 ** 63
+INT64_MAX = 2 ** 63 - 1
+
+
+def _pack_scalar(value, out):
+    if isinstance(value, str):
+        raw = value.encode('utf-8')
+        out.append(b's' + _U32.pack(len(raw)) + raw)
+    elif isinstance(value, int) and not isinstance(value, bool):
+        out.append(b'i' + _I64.pack(value))
+    else:
+        raise ValueError("%r has no binary wire encoding" % (value,))
+
+
+def _unpack_scalar(data, offset):
+    tag = data[offset:offset + 1]
+    offset += 1
+    if tag == b's':
+        length, = _U32.unpack_from(data, offset)
+        offset += 4
+        if offset + length > len(data):
+            raise ValueError("truncated string")
+        return data[offset:offset + length].decode('utf-8'), offset + length
+    if tag == b'i':
+        return _I64.unpack_from(data, offset)[0], offset + 8
+    raise ValueError("unknown scalar tag %r" % tag)
+
+
+# Canonical bytes of a scalar for hash preimages: the wire encoding, or b'j' + u32 length + JSON for anything else.
+def _canonical_scalar(value):
+    if type(value) is str:
+        raw = value.encode('utf-8')
+        return b's' + _U32.pack(len(raw)) + raw
+    if type(value) is int and INT64_MIN <= value <= INT64_MAX:
+        return b'i' + _I64.pack(value)
+    raw = json.dumps(value, sort_keys=True).encode('utf-8')
+    return b'j' + _U32.pack(len(raw)) + raw
 
 
 class Transaction(object):
@@ -16,17 +79,69 @@ class Transaction(object):
         self.sender = sender  # constraint: should exist in state
         self.recipient = recipient  # constraint: need not exist in state. Should exist in state if transaction is applied.
         self.amount = amount  # constraint: sender should have enough balance to send this amount
+        self._txid = None
+        self._size = None
+        self._preimage = None
+        self._leaf = None
 
     def __str__(self) -> str:
         return "T(%s -> %s: %s)" % (self.sender, self.recipient, self.amount)
 
     def encode(self) -> str:
-        return self.__dict__.copy()
+        return {'sender': self.sender, 'recipient': self.recipient, 'amount': self.amount}
 
     @staticmethod
     def decode(data):
         return Transaction(data['sender'], data['recipient'], data['amount'])
 
+    # raises ValueError if a field has no binary encoding
+    def encode_binary(self) -> bytes:
+        out = [WIRE_MAGIC]
+        try:
+            for value in (self.sender, self.recipient, self.amount):
+                _pack_scalar(value, out)
+        except struct.error as e:
+            raise ValueError(e)
+        return b''.join(out)
+
+    @staticmethod
+    def decode_binary(data):
+        if data[:4] != WIRE_MAGIC:
+            raise ValueError("not a binary transaction")
+        try:
+            offset = 4
+            sender, offset = _unpack_scalar(data, offset)
+            recipient, offset = _unpack_scalar(data, offset)
+            amount, offset = _unpack_scalar(data, offset)
+        except (struct.error, UnicodeDecodeError) as e:
+            raise ValueError(e)
+        return Transaction(sender, recipient, amount)
+
+    # Stable content-addressed identifier. Identical transactions share an id, the mempool keeps a copy count for them.
+    # Hashes the length-prefixed `preimage`: the `str` form is ambiguous when account ids contain " -> ".
+    def txid(self) -> str:
+        if self._txid is None:
+            self._txid = hashlib.sha256(self.preimage()).hexdigest()
+        return self._txid
+
+    # canonical bytes of this transaction inside a block hash preimage
+    def preimage(self) -> bytes:
+        if self._preimage is None:
+            self._preimage = _canonical_scalar(self.sender) + _canonical_scalar(self.recipient) + _canonical_scalar(self.amount)
+        return self._preimage
+
+    # Merkle leaf of this transaction, see `Block.merkle_root`
+    def leaf(self) -> bytes:
+        if self._leaf is None:
+            self._leaf = leaf_hash(self.preimage())
+        return self._leaf
+
+    # size in bytes of the JSON encoding, used for block size limits
+    def size(self) -> int:
+        if self._size is None:
+            self._size = len(json.dumps(self.encode()))
+        return self._size
+
     def __lt__(self, other):
         if self.sender < other.sender:
             return True
@@ -43,16 +158,134 @@ class Transaction(object):
     def __eq__(self, other) -> bool:
         return self.sender == other.sender and self.recipient == other.recipient and self.amount == other.amount
 
+    def __hash__(self):
+        return hash((self.sender, self.recipient, self.amount))
+
+
+class Mempool(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.txns = {}  # {txid: Transaction}
+        self.copies = {}  # {txid: number of identical pending copies}
+        # every pending copy kept in `Transaction.__lt__` order, so readers never need to re-sort
+        self.queue = SortedKeyList(key=lambda txn: (txn.sender, txn.recipient, txn.amount))
+        self.bytes = 0  # total `Transaction.size()` of all pending copies
+
+    def __len__(self):
+        return len(self.queue)
+
+    def __contains__(self, txid):
+        return txid in self.txns
+
+    def get(self, txid):
+        return self.txns.get(txid)
+
+    def add(self, txn):
+        return self.add_many([txn])[0]
+
+    # Add every transaction under one lock acquisition, returns their txids. All or nothing: raises ValueError, and adds
+    # none, if one of them can't be ordered with the others (sender and recipient must be strings).
+    def add_many(self, txns):
+        for txn in txns:
+            if type(txn.sender) is not str or type(txn.recipient) is not str or type(txn.amount) is not int:
+                raise ValueError("%s can't be pending" % txn)
+        txids = []
+        with self.lock:
+            for txn in txns:
+                txid = txn.txid()
+                if txid in self.txns:
+                    self.copies[txid] += 1
+                else:
+                    self.txns[txid] = txn
+                    self.copies[txid] = 1
+                self.bytes += txn.size()
+                txids.append(txid)
+            self.queue.update(txns)
+        return txids
+
+    # Remove one pending copy of each given transaction. Transactions that are not pending are ignored.
+    def remove(self, txns):
+        with self.lock:
+            for txn in txns:
+                txid = txn.txid()
+                if txid not in self.txns:
+                    continue
+                self.queue.remove(txn)
+                self.bytes -= txn.size()
+                self.copies[txid] -= 1
+                if self.copies[txid] > 0:
+                    continue
+                del self.copies[txid]
+                del self.txns[txid]
+
+    # pending transactions (including identical copies), ordered by `Transaction.__lt__`
+    def ordered(self):
+        with self.lock:
+            return list(self.queue)
+
+    # One page of `ordered()`: up to `limit` copies after `after`, the (sender, recipient, amount, copy) of the last
+    # copy on the previous page. Continued by key, so commits and admissions between pages don't shift it.
+    # Returns the page and the `after` of the next one, None after the last page.
+    def page(self, limit=None, after=None):
+        with self.lock:
+            start = 0
+            if after is not None:
+                key = tuple(after[:3])
+                start = min(self.queue.bisect_key_left(key) + after[3] + 1, self.queue.bisect_key_right(key))
+            end = len(self.queue) if limit is None else min(start + limit, len(self.queue))
+            txns = list(self.queue.islice(start, end))
+            if end == len(self.queue):
+                return txns, None
+            key = (txns[-1].sender, txns[-1].recipient, txns[-1].amount)
+            return txns, key + (end - 1 - self.queue.bisect_key_left(key),)
+
 
 class Block(object):
-    def __init__(self, number, transactions, previous_hash, miner):
+    def __init__(self, number, transactions, previous_hash, miner, version=3):
         self.number = number  # constraint: should be 1 larger than the previous block
         self.transactions = transactions  # constraint: list of transactions. Ordering matters. They will be applied sequentlally.
         self.previous_hash = previous_hash  # constraint: Should match the previous mined block's hash
         self.miner = miner  # constraint: The node_identifier of the miner who mined this block
-        self.hash = self._hash()
+        self.version = version  # hash preimage format, see `_hash`
+        self.merkle_root = None  # hex Merkle root over the transactions (version 3 and later)
+        if version >= 3:
+            tree = MerkleBuilder()
+            for txn in transactions:
+                tree.add(txn.leaf())
+            self.merkle_root = tree.root().hex()
+        self.hash = self._hash()  # computed once, blocks are not modified after construction
+        self._merkle_levels = None  # full tree, built on the first inclusion proof
 
     def _hash(self):
+        if self.version == 1:
+            return self._legacy_hash()
+        if self.version >= 3:
+            return Block.header_hash(self.number, self.previous_hash, self.miner, len(self.transactions), self.merkle_root)
+        # version 2: canonical bytes of the whole block streamed into the digest
+        digest = hashlib.sha256(b'P2B-block-v2')
+        digest.update(_canonical_scalar(self.number))
+        digest.update(_canonical_scalar(self.previous_hash))
+        digest.update(_canonical_scalar(self.miner))
+        digest.update(_U32.pack(len(self.transactions)))
+        for txn in self.transactions:
+            digest.update(txn.preimage())
+        return digest.hexdigest()
+
+    # version 3: the hash only covers the header, the transactions are covered by the Merkle root.
+    # Static so that a header can be checked without its transactions.
+    @staticmethod
+    def header_hash(number, previous_hash, miner, txn_count, merkle_root):
+        return hashlib.sha256(
+            b'P2B-block-v3' +
+            _canonical_scalar(number) +
+            _canonical_scalar(previous_hash) +
+            _canonical_scalar(miner) +
+            _U32.pack(txn_count) +
+            bytes.fromhex(merkle_root)
+        ).hexdigest()
+
+    # version 1: hash of the stringified fields. Kept so that existing chains still validate.
+    def _legacy_hash(self):
         return hashlib.sha256(
             str(self.number).encode('utf-8') +
             str([str(txn) for txn in self.transactions]).encode('utf-8') +
@@ -63,123 +296,708 @@ class Block(object):
     def __str__(self) -> str:
         return "B(#%s, %s, %s, %s, %s)" % (self.hash[:5], self.number, self.transactions, self.previous_hash, self.miner)
 
-    def encode(self):
-        encoded = self.__dict__.copy()
-        encoded['transactions'] = [t.encode() for t in self.transactions]
+    # `relay_ids`: of the transactions, for an announcement of a block built with relay, see `TransactionRelay.commit`
+    def encode(self, relay_ids=None):
+        encoded = {
+            'number': self.number,
+            'transactions': [t.encode() for t in self.transactions],
+            'previous_hash': self.previous_hash,
+            'miner': self.miner,
+            'version': self.version,
+            'merkle_root': self.merkle_root,
+            'hash': self.hash,
+        }
+        if relay_ids is not None:
+            encoded['relay_ids'] = [list(id) for id in relay_ids]
         return encoded
 
+    # everything needed to check the block hash, without the transactions
+    def header(self):
+        return {
+            'number': self.number,
+            'previous_hash': self.previous_hash,
+            'miner': self.miner,
+            'version': self.version,
+            'txn_count': len(self.transactions),
+            'merkle_root': self.merkle_root,
+            'hash': self.hash,
+        }
+
+    # blocks without a version predate it and use the legacy hash
     @staticmethod
     def decode(data):
+        version = Block.check_version(data.get('version', 1))
         txns = [Transaction.decode(t) for t in data['transactions']]
-        return Block(data['number'], txns, data['previous_hash'], data['miner'])
+        return Block(data['number'], txns, data['previous_hash'], data['miner'], version)
+
+    # raises ValueError unless `version` is one of the hash formats, see `_hash`
+    @staticmethod
+    def check_version(version):
+        if type(version) is not int or version not in (1, 2, 3):
+            raise ValueError("unknown block version %r" % (version,))
+        return version
+
+    # self-contained record for the on-disk block log: b'B' + binary encoding, or b'J' + JSON if it has none
+    def encode_record(self) -> bytes:
+        try:
+            return b'B' + self.encode_binary()
+        except ValueError:
+            return b'J' + json.dumps(self.encode()).encode('utf-8')
+
+    # raises ValueError if the record does not decode to a block with the recorded hash
+    @staticmethod
+    def decode_record(record):
+        kind, body = record[:1], record[1:]
+        if kind == b'B':
+            block, recordedHash = Block.decode_binary(body)
+        elif kind == b'J':
+            values = json.loads(body)
+            block, recordedHash = Block.decode(values), values['hash']
+        else:
+            raise ValueError("unknown block record kind %r" % kind)
+        if block.hash != recordedHash:
+            raise ValueError("block #%s does not match its recorded hash" % block.number)
+        return block
+
+    # Proof that the transaction at `position` is part of this block, checked by `verify_inclusion_proof`.
+    # The tree is kept after the first proof, later proofs of this block cost O(log n).
+    def inclusion_proof(self, position):
+        if self.merkle_root is None:
+            raise ValueError("block #%s (version %s) has no Merkle root" % (self.number, self.version))
+        if self._merkle_levels is None:
+            self._merkle_levels = merkle_levels([txn.leaf() for txn in self.transactions])
+        return {
+            'transaction': self.transactions[position].encode(),
+            'position': position,
+            'path': [node.hex() for node in inclusion_proof(self._merkle_levels, position)],
+            'header': self.header(),
+        }
+
+    # Raises ValueError if a field has no binary encoding. `relay_ids` (see `encode`) follow the transaction records:
+    # u32 count, then an origin and a sequence number scalar each.
+    def encode_binary(self, relay_ids=None) -> bytes:
+        out = [WIRE_MAGIC]
+        accounts = {}  # {"account-id": index in the account table}
+        records = []
+        try:
+            for value in (self.number, self.previous_hash, self.miner, self.hash, self.version):
+                _pack_scalar(value, out)
+            for txn in self.transactions:
+                sender = accounts.setdefault(txn.sender, len(accounts))
+                recipient = accounts.setdefault(txn.recipient, len(accounts))
+                records.append(_TXN_RECORD.pack(sender, recipient, txn.amount))
+            out.append(_U32.pack(len(accounts)))
+            for account in accounts:
+                _pack_scalar(account, out)
+        except struct.error as e:
+            raise ValueError(e)
+        out.append(_U32.pack(len(records)))
+        out.extend(records)
+        if relay_ids is not None:
+            out.append(_U32.pack(len(relay_ids)))
+            try:
+                for origin, sequence in relay_ids:
+                    _pack_scalar(origin, out)
+                    _pack_scalar(sequence, out)
+            except struct.error as e:
+                raise ValueError(e)
+        return b''.join(out)
+
+    # returns the block and the hash claimed by the sender
+    @staticmethod
+    def decode_binary(data):
+        block, received_hash, relay_ids = Block.decode_announcement(data)
+        if relay_ids is not None:
+            raise ValueError("block length mismatch")
+        return block, received_hash
+
+    # `decode_binary` of a block that may be followed by relay ids. Returns the block, the claimed hash and the relay ids
+    # or None.
+    @staticmethod
+    def decode_announcement(data):
+        if data[:4] != WIRE_MAGIC:
+            raise ValueError("not a binary block")
+        try:
+            offset = 4
+            header = []
+            for _ in range(5):
+                value, offset = _unpack_scalar(data, offset)
+                header.append(value)
+            number, previous_hash, miner, received_hash, version = header
+            Block.check_version(version)
+            count, = _U32.unpack_from(data, offset)
+            offset += 4
+            accounts = []
+            for _ in range(count):
+                account, offset = _unpack_scalar(data, offset)
+                accounts.append(account)
+            count, = _U32.unpack_from(data, offset)
+            offset += 4
+            end = offset + count * _TXN_RECORD.size
+            if end > len(data):
+                raise ValueError("block length mismatch")
+            txns = [Transaction(accounts[sender], accounts[recipient], amount) for sender, recipient, amount in _TXN_RECORD.iter_unpack(data[offset:end])]
+            block = Block(number, txns, previous_hash, miner, version)
+            relay_ids = None
+            if end < len(data):
+                count, = _U32.unpack_from(data, end)
+                offset = end + 4
+                if count != len(txns):
+                    raise ValueError("%d relay ids for %d transactions" % (count, len(txns)))
+                relay_ids = []
+                for _ in range(count):
+                    origin, offset = _unpack_scalar(data, offset)
+                    sequence, offset = _unpack_scalar(data, offset)
+                    if type(sequence) is not int:
+                        raise ValueError("malformed relay id %r" % ([origin, sequence],))
+                    relay_ids.append((origin, sequence))
+                if offset != len(data):
+                    raise ValueError("block length mismatch")
+        except (struct.error, UnicodeDecodeError, IndexError) as e:
+            raise ValueError(e)
+        return block, received_hash, relay_ids
+
+
+# blocks as a stream of `Block.encode_record` records, each preceded by its u32 length
+def encode_block_stream(blocks):
+    for block in blocks:
+        record = block.encode_record()
+        yield _U32.pack(len(record)) + record
+
+
+# raises ValueError if the stream is truncated or holds a record that does not decode
+def decode_block_stream(data):
+    blocks = []
+    offset = 0
+    while offset < len(data):
+        if offset + _U32.size > len(data):
+            raise ValueError("truncated block stream")
+        length, = _U32.unpack_from(data, offset)
+        offset += _U32.size
+        if offset + length > len(data):
+            raise ValueError("truncated block stream")
+        blocks.append(Block.decode_record(data[offset:offset + length]))
+        offset += length
+    return blocks
+
+
+# Check an inclusion proof from `Block.inclusion_proof` without the chain: the header must hash to its claimed hash,
+# and the Merkle path must lead from the transaction to the header's root. The proof is untrusted, a malformed one is
+# just not valid.
+def verify_inclusion_proof(proof) -> bool:
+    try:
+        header = proof['header']
+        if header.get('version', 1) < 3:
+            return False
+        expected = Block.header_hash(header['number'], header['previous_hash'], header['miner'], header['txn_count'], header['merkle_root'])
+        if expected != header['hash']:
+            return False
+        leaf = Transaction.decode(proof['transaction']).leaf()
+        path = [bytes.fromhex(node) for node in proof['path']]
+        return verify_inclusion(leaf, proof['position'], header['txn_count'], path, bytes.fromhex(header['merkle_root']))
+    except (KeyError, ValueError, TypeError, AttributeError, struct.error):
+        return False
+
+
+class StateOverlay(object):
+    # Copy-on-write view of a balance map. Reads fall through to `base`, writes only land in `delta`. Changes reach the
+    # state through `State.apply_changes`, which also records them in the history.
+    # Cost scales with the number of touched accounts, not with the size of `base`. Overlays can be stacked.
+    def __init__(self, base):
+        self.base = base  # {"account-id": <amount>} or another `StateOverlay`
+        self.delta = {}  # {"account-id": <amount>} accounts written through this view
+
+    def __contains__(self, account):
+        return account in self.delta or account in self.base
+
+    def __getitem__(self, account):
+        if account in self.delta:
+            return self.delta[account]
+        return self.base[account]
+
+    def __setitem__(self, account, amount):
+        self.delta[account] = amount
+
+    def get(self, account, default=None):
+        if account in self:
+            return self[account]
+        return default
+
+
+class AccountBalances(object):
+    # dict-like {"account-id": <amount>} view of the interned balances of a `State`
+    def __init__(self, state):
+        self.state = state
+
+    def __contains__(self, account):
+        return account in self.state.ids
+
+    def __getitem__(self, account):
+        return self.state.balances[self.state.ids[account]]
+
+    def __setitem__(self, account, amount):
+        self.state.balances[self.state.intern(account)] = amount
+
+    def __len__(self):
+        return len(self.state.names)
+
+    def __iter__(self):
+        return iter(self.state.names)
+
+    def get(self, account, default=None):
+        if account in self.state.ids:
+            return self.state.balances[self.state.ids[account]]
+        return default
+
+    def items(self):
+        return zip(self.state.names, self.state.balances)
 
 
 class State(object):
     def __init__(self):
         # You might want to think how you will store balance per person.
-        self.account = {}  # {"account-id": <amount>}
-        self.historyList = {}  # {"account": [(block #, amount)]}
+        # Accounts are interned to dense integer ids, everything else is kept in typed arrays indexed by id.
+        self.ids = {}  # {"account-id": id}
+        self.names = []  # ["account-id"] by id
+        self.balances = array('q')  # balance by id
+        # history by id: one array of (block # in which the account changed, net change in that block, balance after it)
+        # triples per account. The balances are prefix sums of the changes.
+        self.historyList = []
+        self.account = AccountBalances(self)  # {"account-id": <amount>}
         # You don't need to worry about persisting to disk. Storing in memory is fine.
         pass
 
-    def encode(self):
+    # id of `account`, created with a zero balance and no history on first sight
+    def intern(self, account):
+        id = self.ids.get(account)
+        if id is None:
+            # published last: lock-free readers find an account's arrays as soon as they find its name or id
+            id = len(self.names)
+            self.balances.append(0)
+            self.historyList.append(array('q'))
+            self.names.append(account)
+            self.ids[account] = id
+        return id
+
+    # `number`: as of that block, see `items`
+    def encode(self, number=None):
         dumped = {}
         # Add all person -> balance pairs into `dumped`.
-        dumped.update(self.account)
+        dumped.update(self.items(number))
         return dumped
 
-    def validate_txns(self, txns):
+    # (account, balance) pairs, current ones or as of block `number`. As of a block, read off the history only: safe
+    # while later blocks are being applied, accounts created after it are left out.
+    def items(self, number=None):
+        if number is None:
+            return self.account.items()
+        return self.__items_at(number)
+
+    def __items_at(self, number):
+        for id in range(len(self.names)):
+            history = self.historyList[id]
+            last = history[-3:]  # one read, the applier may be extending it
+            if len(last) == 3 and last[0] <= number:
+                yield self.names[id], last[2]
+                continue
+            position = self.__history_after(id, number) - 1
+            if position >= 0:
+                yield self.names[id], history[3 * position + 2]
+
+    # plain copy of balances and history for `SnapshotStore`. Pairs instead of dicts keep non-string account ids intact.
+    def snapshot(self):
+        return {
+            'account': list(self.account.items()),
+            'history': [[account, self.history(account)] for account in self.names],
+        }
+
+    @staticmethod
+    def restore(data):
+        state = State()
+        for account, amount in data['account']:
+            state.account[account] = amount
+        for account, entries in data['history']:
+            history = state.historyList[state.intern(account)]
+            balances = itertools.accumulate(entry[1] for entry in entries)
+            for (number, amount), balance in zip(entries, balances):
+                history.extend((number, amount, balance))
+        return state
+
+    # a throw-away view of the committed balances, or of `base` (an overlay over them), see `StateOverlay`
+    def overlay(self, base=None):
+        return StateOverlay(self.account if base is None else base)
+
+    def validate_txns(self, txns, base=None):
         result = []
         # returns a list of valid transactions.
         # You receive a list of transactions, and you try applying them to the state sequentially.
         # If a transaction can be applied, add it to result. (should be included)
         # note dependent tnx
         # do not commit to state
-        stateCopy = self.account.copy()
+        stateCopy = self.overlay(base)
         for txn in txns:
-            if txn.sender not in stateCopy:
-                continue
-            if txn.recipient not in stateCopy:
-                stateCopy[txn.recipient] = 0
-            if stateCopy[txn.sender] < txn.amount:
-                continue
-            stateCopy[txn.sender] -= txn.amount
-            stateCopy[txn.recipient] += txn.amount
-            result.append(txn)
+            if self.__transfer(stateCopy, txn):
+                result.append(txn)
 
         return result
 
-    def apply_block(self, block):
-        # apply the block to the state.
-        if (block.number == 1):
-            self.account['A'] = 10000
-            self.historyList['A'] = [(block.number, self.account['A'])]
+    # `validate_txns` on an overlay that keeps the valid ones applied, so that a later call continues after them
+    def validate_onto(self, stateCopy, txns):
+        return [txn for txn in txns if self.__transfer(stateCopy, txn)]
 
-        logging.info("Block (#%s) applied to state. %d transactions applied" % (block.hash, len(block.transactions)))
+    # Apply `txn` to the overlay `stateCopy` if it is valid: a 64 bit amount the sender has, and no balance, or net
+    # change of a balance in the block, leaves 64 bits. Returns whether it was applied.
+    @staticmethod
+    def __transfer(stateCopy, txn):
+        amount = txn.amount
+        if type(amount) is not int or not INT64_MIN <= amount <= INT64_MAX:
+            return False
+        if txn.sender not in stateCopy or stateCopy[txn.sender] < amount:
+            return False
+        sent = stateCopy[txn.sender] - amount
+        received = (sent if txn.recipient == txn.sender else stateCopy.get(txn.recipient, 0)) + amount
+        for account, balance in ((txn.sender, sent), (txn.recipient, received)):
+            if not INT64_MIN <= balance <= INT64_MAX or not INT64_MIN <= balance - stateCopy.base.get(account, 0) <= INT64_MAX:
+                return False
+        stateCopy[txn.sender] = sent
+        stateCopy[txn.recipient] = received
+        return True
 
-        for tnx in block.transactions:
-            self.account[tnx.sender] -= tnx.amount
-            if not tnx.recipient in self.account:
-                self.account[tnx.recipient] = 0
-            self.account[tnx.recipient] += tnx.amount
+    # Block packing: like `validate_txns`, but a transaction skipped for lack of funds is retried once one of
+    # its sender's incoming transactions got admitted, until nothing changes (fixpoint).
+    # The result is ordered by admission, so `validate_txns` accepts it sequentially on every peer.
+    # Deterministic: depends only on the state and the order of `txns`.
+    def select_txns(self, txns, base=None):
+        result = []
+        stateCopy = self.overlay(base)
+        waiting = {}  # {"sender": [(position, txn)]} skipped transactions, indexed by the account that could enable them
+        credited = set()  # accounts that received funds during the current round
+
+        def admit(txn):
+            if not self.__transfer(stateCopy, txn):
+                return False
+            result.append(txn)
+            credited.add(txn.recipient)
+            return True
+
+        for position, txn in enumerate(txns):
+            if not admit(txn):
+                waiting.setdefault(txn.sender, []).append((position, txn))
 
-            if tnx.sender not in self.historyList:
-                self.historyList[tnx.sender] = []
-            if tnx.recipient not in self.historyList:
-                self.historyList[tnx.recipient] = [[block.number, 0]]
+        # each round retries, in original order, the skipped transactions of accounts credited in the previous round
+        while credited:
+            candidates = []
+            for account in credited:
+                candidates.extend(waiting.pop(account, ()))
+            credited = set()
+            candidates.sort(key=lambda entry: entry[0])
+            for position, txn in candidates:
+                if not admit(txn):
+                    waiting.setdefault(txn.sender, []).append((position, txn))
 
-            last = len(self.historyList[tnx.sender]) - 1
-            if(not (len(self.historyList[tnx.sender]) > 0 and self.historyList[tnx.sender][last][0] == block.number)):
-              self.historyList[tnx.sender].append([block.number, 0])
-              last += 1
-            
-            self.historyList[tnx.sender][last][1] -= tnx.amount
+        return result
+
+    # Validate the transactions of `block` and apply them to an overlay in one pass. Returns the overlay, for
+    # `apply_changes`, or None if a transaction is invalid. The state itself is not touched either way.
+    # `base`: the `execute` result of the block before, not applied yet, to run on top of it (speculatively).
+    def execute(self, block, base=None):
+        changes = self.overlay(base)
+        # hot loop: reads and writes the overlay's delta and the balance arrays directly
+        delta = changes.delta
+        pending = {} if base is None else base.delta
+        ids = self.ids
+        balances = self.balances
+        for txn in block.transactions:
+            amount = txn.amount
+            if type(amount) is not int or not INT64_MIN <= amount <= INT64_MAX:
+                return None
+            balance = delta.get(txn.sender)
+            if balance is None:
+                balance = pending.get(txn.sender)
+            if balance is None:
+                if txn.sender not in ids:
+                    return None
+                balance = balances[ids[txn.sender]]
+            if balance < amount or balance - amount > INT64_MAX:
+                return None
+            delta[txn.sender] = balance - amount
+            balance = delta.get(txn.recipient)
+            if balance is None:
+                balance = pending.get(txn.recipient)
+            if balance is None:
+                balance = balances[ids[txn.recipient]] if txn.recipient in ids else 0
+            if not INT64_MIN <= balance + amount <= INT64_MAX:
+                return None
+            delta[txn.recipient] = balance + amount
+        # after the transactions: they are checked against the state before the genesis block
+        if block.number == 1:
+            changes['A'] = 10000
+        # the net change of every account goes into its history
+        for account, amount in delta.items():
+            balance = pending.get(account)
+            if balance is None:
+                balance = balances[ids[account]] if account in ids else 0
+            if not INT64_MIN <= amount - balance <= INT64_MAX:
+                return None
+        return changes
+
+    # The overlay `execute` returned as [(account, new balance, net change)], nothing applied yet.
+    # Raises ValueError if a balance or change does not fit the 64 bit arrays.
+    def prepare_changes(self, changes):
+        updates = []
+        for account, amount in changes.delta.items():
+            change = amount - self.balance(account)
+            if not INT64_MIN <= amount <= INT64_MAX or not INT64_MIN <= change <= INT64_MAX:
+                raise ValueError("balance of %s out of range" % (account,))
+            updates.append((account, amount, change))
+        return updates
 
+    # Commit the overlay `execute` returned for `block`, or its `prepare_changes` updates.
+    # Every touched account gets its net change in its history.
+    def apply_changes(self, block, changes):
+        updates = self.prepare_changes(changes) if isinstance(changes, StateOverlay) else changes
+        for account, amount, change in updates:
+            id = self.intern(account)
+            self.balances[id] = amount
+            self.__record(id, block.number, change)
 
+        logging.info("Block (#%s) applied to state. %d transactions applied" % (block.hash, len(block.transactions)))
 
-            last = len(self.historyList[tnx.recipient]) - 1
-            if(not (len(self.historyList[tnx.recipient]) > 0 and self.historyList[tnx.recipient][last][0] == block.number)):
-              self.historyList[tnx.recipient].append([block.number, 0])
-              last += 1
-            
-            self.historyList[tnx.recipient][last][1] += tnx.amount
+    # apply the block to the state. Raises ValueError, and changes nothing, if it does not apply.
+    def apply_block(self, block):
+        changes = self.execute(block)
+        if changes is None:
+            raise ValueError("block #%s does not apply to the state" % block.number)
+        self.apply_changes(block, changes)
 
+    # add `amount` to the history of account `id` in block `number`. Changes within one block are aggregated.
+    def __record(self, id, number, amount):
+        history = self.historyList[id]
+        if len(history) > 0 and history[-3] == number:
+            history[-2] += amount
+            history[-1] = self.balances[id]
+        else:
+            history.extend((number, amount, self.balances[id]))
+
+    # position of the first history entry of account `id` after block `number` (bisect_right over the block numbers)
+    def __history_after(self, id, number):
+        history = self.historyList[id]
+        return bisect.bisect_right(range(len(history) // 3), number, key=lambda i: history[3 * i])
+
+    # Balance of `account` after block `number`, O(log n) by binary search over its history. Current balance if None.
+    def balance(self, account, number=None):
+        if number is None:
+            return self.account.get(account, 0)
+        if account not in self.ids:
+            return 0
+        id = self.ids[account]
+        last = self.historyList[id][-3:]  # one read, the applier may be extending it
+        if len(last) == 3 and last[0] <= number:
+            return last[2]  # no change since `number`, O(1) for the current balance
+        position = self.__history_after(id, number) - 1
+        if position < 0:
+            return 0
+        return self.historyList[id][3 * position + 2]
 
     def history(self, account):
         # return a list of (blockNumber, value changes) that this account went through
         list = []  # [[blocknumber, amount],...]
 
-        if not account in self.historyList:
+        if not account in self.ids:
             return list
 
-        # for h in self.historyList[account]:
-        #     list.append([h[0], h[1]])
-
-        list.extend(self.historyList[account])
-        # print(list)
+        history = self.historyList[self.ids[account]]
+        list.extend([history[i], history[i + 1]] for i in range(0, len(history), 3))
 
         return list
 
+    # One page of the history of `account`, without copying it: entries with from_block <= block number <= to_block,
+    # located by binary search, starting at `cursor` (a position returned as `next` by the previous page), at most `limit`.
+    # Returns (iterator over the [block number, amount] entries, cursor of the next page or None).
+    def history_page(self, account, from_block=None, to_block=None, limit=None, cursor=None):
+        if account not in self.ids:
+            return iter(()), None
+        id = self.ids[account]
+        history = self.historyList[id]
+        start = 0 if from_block is None else self.__history_after(id, from_block - 1)
+        end = len(history) // 3 if to_block is None else self.__history_after(id, to_block)
+        if cursor is not None:
+            start = max(start, cursor)
+        next = None
+        if limit is not None and end - start > limit:
+            end = start + limit
+            next = end
+        return ([history[3 * i], history[3 * i + 1]] for i in range(start, end)), next
+
+
+class BlockBuffer(object):
+    # Blocks that arrived ahead of the chain, by number, held until the blocks before them are committed.
+    # Bounded: when full, the block furthest ahead is evicted, it is the last one the chain will need.
+    def __init__(self, capacity=64):
+        self.capacity = capacity
+        self.blocks = {}  # {block number: (Block, received hash, relay ids or None)}
+
+    def __len__(self):
+        return len(self.blocks)
+
+    # Returns False if the block is not kept: its number is taken, or it is further ahead than everything held in a full buffer.
+    def add(self, block, received_hash, relay_ids=None):
+        if block.number in self.blocks:
+            return False
+        if len(self.blocks) >= self.capacity:
+            if not self.blocks:
+                return False  # no capacity at all
+            furthest = max(self.blocks)
+            if furthest < block.number:
+                return False
+            del self.blocks[furthest]
+            logging.info("[BUFFER] evicted block #%s" % furthest)
+        self.blocks[block.number] = (block, received_hash, relay_ids)
+        return True
+
+    # (block, received hash, relay ids) numbered `number`, removed from the buffer, or None. Blocks before it are dropped.
+    def pop(self, number):
+        for stale in [n for n in self.blocks if n < number]:
+            del self.blocks[stale]
+        return self.blocks.pop(number, None)
+
+    def lowest(self):
+        return min(self.blocks) if self.blocks else None
+
+
+class CommandQueue(object):
+    # Serializes every mutation of a node: commands run one at a time, in submission order, on a single applier
+    # thread. Back-to-back batch commands of the same function are merged into one call.
+    def __init__(self):
+        self.queue = queue.SimpleQueue()  # (Future, fn, args, batch)
+        self.lock = threading.Lock()
+        self.thread = None
+
+    # Runs fn(*args) on the applier thread and returns its result. Inline when called from the applier itself.
+    def call(self, fn, *args):
+        if threading.current_thread() is self.thread:
+            return fn(*args)
+        return self.__submit(fn, args, False).result()
+
+    # Runs fn([items, ...]) on the applier thread, where `items` may be joined by those of other callers of the same
+    # function. fn returns one result per `items`, this caller's is returned. fn must change nothing when it raises:
+    # the callers of a failed merged call are then run one by one, so only the one at fault gets the exception.
+    def call_batch(self, fn, items):
+        if threading.current_thread() is self.thread:
+            return fn([items])[0]
+        return self.__submit(fn, items, True).result()
+
+    def __submit(self, fn, args, batch):
+        future = Future()
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.__apply, name='applier', daemon=True)
+                self.thread.start()
+        self.queue.put((future, fn, args, batch))
+        return future
+
+    def __apply(self):
+        command = None
+        while True:
+            if command is None:
+                command = self.queue.get()
+            future, fn, args, batch = command
+            command = None
+            if not batch:
+                self.__run([future], lambda: [fn(*args)])
+                continue
+            futures, batches = [future], [args]
+            while True:
+                try:
+                    following = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if not following[3] or following[1] != fn:
+                    command = following  # runs after this batch
+                    break
+                futures.append(following[0])
+                batches.append(following[2])
+            if len(futures) == 1:
+                self.__run(futures, lambda: fn(batches))
+                continue
+            try:
+                results = fn(batches)
+            except BaseException:
+                for future, items in zip(futures, batches):
+                    self.__run([future], lambda: fn([items]))
+                continue
+            for future, result in zip(futures, results):
+                future.set_result(result)
+
+    # the failure of a command is raised to its callers, the applier carries on
+    @staticmethod
+    def __run(futures, run):
+        try:
+            results = run()
+        except BaseException as e:
+            for future in futures:
+                future.set_exception(e)
+            return
+        for future, result in zip(futures, results):
+            future.set_result(result)
+
 
 class Blockchain(object):
     def __init__(self):
         self.nodes = []
         self.node_identifier = 0
-        self.block_mine_time = 5
+        self.block_mine_time = 5  # deadline: a requested block is built at the latest this many seconds later
+        self.block_min_time = 0  # a requested block is never built sooner than this many seconds
+        self.block_max_txns = None  # build early once this many transactions are pending, and put at most this many in a block
+        self.block_max_bytes = None  # build early once this many bytes are pending, and put at most this many in a block
+        self.block_packing = 'fixpoint'  # 'fixpoint' (`State.select_txns`) or 'sequential' (`State.validate_txns`)
+        self.wire_format = 'binary'  # 'binary' or 'json' encoding of broadcast blocks
 
         # in memory datastructures.
-        self.current_transactions = []  # A list of pending  `Transaction`
+        self.mempool = Mempool()  # pending `Transaction`s
         self.chain = []  # A list of committed `Block`s
         self.state = State()
+        self.txn_index = {}  # {txid: [(block number, position)]} where committed transactions are
+        self.hash_index = {}  # {block hash: block number}, block number n is self.chain[n - 1]
+        self.log = None  # `BlockLog` committed blocks are persisted to, None to keep the chain in memory only
+        self.snapshot_blocks = 1000  # write a state snapshot every this many blocks (0: never), with a block log
+        self.snapshot_interval = 300  # or every this many seconds (0: never)
+        self.snapshot_signal = threading.Condition()
+        self.snapshot_requested = False  # set under `snapshot_signal` when `snapshot_blocks` more blocks were committed
+        self.transport = PeerTransport()  # connections to the other nodes
+        self.sync_batch_blocks = 500  # blocks fetched per request when catching up with a peer
+        self.sync_lock = threading.Lock()  # held while catching up, so at most one catch-up runs
+        # Every change to the chain, state, indexes, mempool and block buffer runs on the applier thread of `commands`.
+        # Readers take no lock: they only look at blocks up to `height`, which is published after a block is fully applied.
+        self.commands = CommandQueue()
+        self.height = 0  # number of the last block whose commit is complete
+        self.block_buffer = BlockBuffer()  # blocks received ahead of the chain, committed once the gap closes
+        self.block_buffer_wait = 1.0  # seconds a gap may stay open before catching up from the peers
+        self.relay = None  # `TransactionRelay` of submitted transactions to the upcoming proposers, None if disabled
+        self.relay_proposers = 0  # number of upcoming proposers transactions are relayed to
+        self.announce_relay_ids = {}  # {block number: relay ids of its transactions} of blocks built here, until announced
+
+        # block production: one long-lived miner worker, woken up through `mine_signal`
+        self.mine_signal = threading.Condition()
+        self.unpackable = (0, 0)  # (count, bytes) of pending transactions no block can include yet
+        self.packable = None  # overlay with every pending transaction a block can include applied, see `__count_admitted`
+        self.mine_requests = {}  # {block number: (genesis, requested at)} of the blocks this node has to build
+        self.mine_proposed = []  # [Block] built speculatively on the applier, for the miner to broadcast
+        self.miner_thread = None
+        # Pipelined proposal: this node starts collecting transactions for each of the next `pipeline_depth` blocks it
+        # proposes as soon as the block `pipeline_depth` before it is committed. A block whose time is up before the
+        # block before it arrives is built right when that one is received, on its not yet applied state. 1: off.
+        self.pipeline_depth = 1
 
     # Determine if I should accept a new block. Does it pass all semantic checks? Search for "constraint" in this file.
     # :param block: A new proposed block
+    # :param check_txns: False to leave the transactions to `State.execute`
     # :return: True if valid, False if not
     # """
-    def is_new_block_valid(self, block, received_blockhash):  # needs to check all constraints if a block is valid
+    def is_new_block_valid(self, block, received_blockhash, check_txns=True):  # needs to check all constraints if a block is valid
         # if genesis block
         genesis = False
-        genesisBlock = Block(1, [], '0xfeedcafe', block.miner)
+        genesisBlock = Block(1, [], '0xfeedcafe', block.miner, block.version)
         if (block.previous_hash == genesisBlock.hash and block.number == 1 or len(self.chain) == 0):
             genesis = True
 
@@ -204,9 +1022,10 @@ class Blockchain(object):
         if (block.previous_hash != prevHash):
             return False
         # 3. Transactions should be valid (all apply to block)
-        validTnxs = self.state.validate_txns(block.transactions)
-        if (len(validTnxs) != len(block.transactions)):
-            return False
+        if check_txns:
+            validTnxs = self.state.validate_txns(block.transactions)
+            if (len(validTnxs) != len(block.transactions)):
+                return False
         # 4. Block number should be one higher than previous block
         if (block.number <= prevNumber):
             return False
@@ -222,9 +1041,302 @@ class Blockchain(object):
 
         return True
 
-    def trigger_new_block_mine(self, genesis=False):  # call this method when you want this node to create a block.
-        thread = threading.Thread(target=self.__mine_new_block_in_thread, args=(genesis,))
-        thread.start()
+    # Validate a block from another node and commit it, followed by the buffered blocks it lets through.
+    # Returns False, and leaves the chain alone, if it is invalid. `relay_ids`: of its transactions, when it was
+    # announced with them, see `TransactionRelay.commit`.
+    def receive_block(self, block, received_blockhash, relay_ids=None):
+        return self.commands.call(self.__receive_block, block, received_blockhash, relay_ids)
+
+    def __receive_block(self, block, received_blockhash, relay_ids=None):
+        if not self.__validate_and_commit(block, received_blockhash, relay_ids):
+            return False
+        self.__drain_buffer()
+        self.__publish()
+        return True
+
+    # runs on the applier
+    def __validate_and_commit(self, block, received_blockhash, relay_ids=None):
+        if not self.is_new_block_valid(block, received_blockhash, check_txns=False):
+            return False
+        # the transactions are validated and applied in a single pass, to an overlay that is only committed if all are valid
+        changes = self.state.execute(block)
+        if changes is None:
+            return False
+        # relayed transactions are pending on several nodes, drop the copies the proposer just committed
+        committed = self.relay.commit(block.number, block.transactions, relay_ids) if self.relay is not None else []
+        proposed = self.__propose_after(block, changes, committed)
+        self.commit_block(block, changes, publish=False)
+        self.mempool.remove(committed)
+        if proposed is not None:
+            self.__commit_proposed(*proposed)
+        return True
+
+    # Pipelined proposal, on the applier: if this node's next block is due, build it now on the state after `block`,
+    # an overlay stacked on `changes`, before `block` is committed. Returns (block, changes) or None.
+    # Should committing `block` fail, the speculative block is dropped with it, it was not announced.
+    # `committed`: the pending copies `block` commits, they are left out.
+    def __propose_after(self, block, changes, committed):
+        if self.pipeline_depth <= 1 or not self.__take_mine_request(block.number + 1):
+            return None
+        left = collections.Counter(txn.txid() for txn in committed)
+        pending = []
+        for txn in self.mempool.ordered():
+            if left[txn.txid()] > 0:
+                left[txn.txid()] -= 1
+            else:
+                pending.append(txn)
+        txnsWorkingSet = self.__pack_block(pending, base=changes)
+        proposed = Block(block.number + 1, txnsWorkingSet, block.hash, self.node_identifier)
+        logging.info("[MINER] built block #%s speculatively on top of #%s" % (proposed.number, block.number))
+        return proposed, self.state.execute(proposed, base=changes)
+
+    def __commit_proposed(self, block, changes):
+        self.__take_pending(block)
+        self.commit_block(block, changes)  # with the block before it: both on disk before it is announced
+        with self.mine_signal:
+            self.mine_proposed.append(block)
+            self.mine_signal.notify()
+
+    # commit the buffered blocks that now follow the chain, in order. Invalid ones are dropped.
+    def __drain_buffer(self):
+        while True:
+            entry = self.block_buffer.pop(len(self.chain) + 1)
+            if entry is None:
+                return
+            if self.__validate_and_commit(*entry):
+                logging.info("[BUFFER] committed block #%s" % entry[0].number)
+            else:
+                logging.warning("[BUFFER] dropped invalid block #%s" % entry[0].number)
+
+    # blocks were missed between the last committed one and `block`
+    def is_ahead(self, block):
+        return block.number > len(self.chain) + 1
+
+    # Hold `block` back if it is ahead of the chain, it is committed after the ones before it. Returns False if it is not
+    # ahead. The missing blocks are fetched from the peers if they are more than one, or do not arrive in time.
+    def buffer_if_ahead(self, block, received_blockhash, relay_ids=None):
+        missing = self.commands.call(self.__buffer_if_ahead, block, received_blockhash, relay_ids)
+        if missing == 0:
+            return False
+        if missing > 1:
+            self.request_sync(block.miner)
+        else:
+            timer = threading.Timer(self.block_buffer_wait, self.__sync_if_gap, (block.miner,))
+            timer.daemon = True
+            timer.start()
+        return True
+
+    # number of blocks missing before `block`, which is buffered if there are any
+    def __buffer_if_ahead(self, block, received_blockhash, relay_ids=None):
+        if not self.is_ahead(block):
+            return 0
+        if self.block_buffer.add(block, received_blockhash, relay_ids):
+            logging.info("[BUFFER] holding block #%s until #%s arrives" % (block.number, len(self.chain) + 1))
+        return block.number - len(self.chain) - 1
+
+    def __sync_if_gap(self, preferred):
+        lowest = self.commands.call(self.block_buffer.lowest)
+        if lowest is not None and lowest > self.height + 1:
+            self.request_sync(preferred)
+
+    # make nodes propose blocks in Round Robin fashion: start mining if this node proposes the block after the last one,
+    # or one of the next `pipeline_depth` blocks
+    def mine_if_next(self):
+        height = self.height
+        previousMiner = self.chain[height - 1].miner
+        for ahead in range(1, self.pipeline_depth + 1):
+            nextMinerIndex = (self.nodes.index(previousMiner) + ahead) % len(self.nodes)
+            if self.node_identifier == self.nodes[nextMinerIndex]:
+                self.trigger_new_block_mine(number=height + ahead)
+
+    # Catch up with the other nodes in the background, asking `preferred` first. Does nothing if a catch-up is running:
+    # that one keeps fetching until its peer has no more blocks.
+    def request_sync(self, preferred=None):
+        if not self.sync_lock.acquire(blocking=False):
+            return
+
+        peers = [node for node in self.nodes if node != self.node_identifier]
+        if preferred in peers:
+            peers.remove(preferred)
+            peers.insert(0, preferred)
+
+        def run():
+            try:
+                if self.catch_up(peers) > 0:
+                    self.mine_if_next()
+            except Exception:
+                logging.exception("[SYNC] catch-up failed")
+            finally:
+                self.sync_lock.release()
+        threading.Thread(target=run, daemon=True).start()
+
+    # Fetch and commit the blocks after the last committed one, from each peer in turn. Returns the number committed.
+    def catch_up(self, peers):
+        started = time.monotonic()
+        applied = 0
+        for peer in peers:
+            applied += self.__sync_from(peer)
+        if applied > 0:
+            elapsed = time.monotonic() - started
+            logging.info("[SYNC] caught up %d blocks in %.3fs (%.0f blocks/s)" % (applied, elapsed, applied / max(elapsed, 1e-9)))
+        return applied
+
+    # Batches are fetched one ahead: batch k+1 is downloaded, decoded and hashed on a transport worker while
+    # batch k is validated and committed here.
+    def __sync_from(self, peer):
+        applied = 0
+        fetch = self.transport.pool.submit(self.fetch_blocks, peer, self.height + 1, self.sync_batch_blocks)
+        while True:
+            blocks = fetch.result()
+            if not blocks:
+                return applied
+            fetch = self.transport.pool.submit(self.fetch_blocks, peer, blocks[-1].number + 1, self.sync_batch_blocks)
+            committed, invalid = self.commands.call(self.__commit_fetched, blocks)
+            applied += committed
+            if invalid is not None:
+                logging.warning("[SYNC] %s sent invalid block #%s, giving up on it" % (peer, invalid.number))
+                fetch.cancel()
+                return applied
+
+    # Commits a fetched batch of blocks as one command. Returns (number committed, the first invalid block or None).
+    # The blocks are made durable together, with one fsync.
+    def __commit_fetched(self, blocks):
+        committed = 0
+        try:
+            for block in blocks:
+                if block.number <= len(self.chain):
+                    continue  # committed meanwhile through /inform/block
+                if not self.__validate_and_commit(block, block.hash):
+                    return committed, block
+                committed += 1
+            self.__drain_buffer()
+            return committed, None
+        finally:
+            self.__publish()
+
+    # up to `limit` committed blocks of `peer` from number `start` on, None if it could not be reached or answered garbage
+    def fetch_blocks(self, peer, start, limit):
+        response = self.transport.get(peer, '/blocks', params={'from': start, 'limit': limit, 'format': 'binary'})
+        if response is None or response.status_code != 200:
+            return None
+        try:
+            return decode_block_stream(response.content)
+        except ValueError as e:
+            logging.warning("[SYNC] malformed blocks from %s: %s" % (peer, e))
+            return None
+
+    # `number`: of the block to create, default: the one after the last committed block
+    def trigger_new_block_mine(self, genesis=False, number=None):  # call this method when you want this node to create a block.
+        with self.mine_signal:
+            if self.miner_thread is None:
+                self.miner_thread = threading.Thread(target=self.__mine_blocks, daemon=True)
+                self.miner_thread.start()
+            if number is None:
+                number = self.height + 1
+            if number not in self.mine_requests:
+                self.mine_requests[number] = (genesis, time.monotonic())
+            self.mine_signal.notify()
+
+    # Removes the request for block `number` if it is due. Returns whether it was.
+    def __take_mine_request(self, number):
+        with self.mine_signal:
+            request = self.mine_requests.get(number)
+            if request is None or self.__block_due_in(request[1]) > 0:
+                return False
+            del self.mine_requests[number]
+            return True
+
+    # seconds left until the requested block is due, 0 when it should be built now
+    def __block_due_in(self, requested):
+        elapsed = time.monotonic() - requested
+        if elapsed < self.block_min_time:
+            return self.block_min_time - elapsed
+        # transactions that could not be included last time, e.g. unfunded ones, don't make a block due
+        count, size = self.unpackable
+        if self.block_max_txns is not None and len(self.mempool) - count >= self.block_max_txns:
+            return 0
+        if self.block_max_bytes is not None and self.mempool.bytes - size >= self.block_max_bytes:
+            return 0
+        return max(0, self.block_mine_time - elapsed)
+
+    # miner worker: waits for a block request, then builds the block once a size trigger or the deadline is reached
+    # and the block before it is committed. Also broadcasts the blocks built speculatively on the applier.
+    def __mine_blocks(self):
+        while True:
+            with self.mine_signal:
+                while not self.mine_requests and not self.mine_proposed:
+                    self.mine_signal.wait()
+                logging.info("[MINER] waiting for new transactions before mining new block...")
+                request = self.__next_mine_request()
+                while request is None and not self.mine_proposed:
+                    self.mine_signal.wait(self.__mine_wait())
+                    request = self.__next_mine_request()
+                proposed = self.mine_proposed.pop(0) if request is None else None
+            try:
+                if proposed is not None:
+                    self.__announce_block(proposed)
+                else:
+                    self.__mine_new_block(*request)
+                if self.pipeline_depth > 1:
+                    self.mine_if_next()
+            except Exception:
+                logging.exception("[MINER] failed to mine a new block")
+
+    # (genesis, number) of the block to build now, None if there is none. Caller holds `mine_signal`.
+    def __next_mine_request(self):
+        height = self.height
+        for number in [number for number in self.mine_requests if number <= height]:
+            del self.mine_requests[number]  # the block was committed meanwhile
+        request = self.mine_requests.get(height + 1)
+        if request is None or self.__block_due_in(request[1]) > 0:
+            return None
+        del self.mine_requests[height + 1]
+        return request[0], height + 1
+
+    # seconds until the next requested block is due, None to wait for a commit. Caller holds `mine_signal`.
+    def __mine_wait(self):
+        if not self.mine_requests:
+            return None
+        wait = self.__block_due_in(self.mine_requests[min(self.mine_requests)][1])
+        return wait if wait > 0 else None
+
+    # The transactions of a block, out of `pending`, on the committed state or an overlay `base` over it.
+    def __pack_block(self, pending, base=None):
+        return self.__fit_block(self.__select_block_txns(pending, base))
+
+    # Counts admitted transactions that don't apply on top of every packable pending one as unpackable, O(1) each.
+    # One an admission enables stays counted until the next block or commit selects again.
+    def __count_admitted(self, txns):
+        if self.packable is None:
+            return
+        accepted = self.state.validate_onto(self.packable, txns)
+        count, size = self.unpackable
+        self.unpackable = (count + len(txns) - len(accepted), size + sum(txn.size() for txn in txns) - sum(txn.size() for txn in accepted))
+
+    # the valid transactions out of `pending`, in packing order. Also counts the ones that aren't, the size
+    # triggers leave them out.
+    def __select_block_txns(self, pending, base=None):
+        if self.block_packing == 'fixpoint':
+            selected = self.state.select_txns(pending, base)
+        else:
+            selected = self.state.validate_txns(pending, base)
+        self.unpackable = (len(pending) - len(selected), sum(txn.size() for txn in pending) - sum(txn.size() for txn in selected))
+        if self.block_max_txns is not None or self.block_max_bytes is not None:
+            self.packable = self.state.overlay(base)
+            self.state.validate_onto(self.packable, selected)
+        return selected
+
+    # cut an admission-ordered selection at the block limits. Any prefix of it is still valid.
+    def __fit_block(self, txns):
+        if self.block_max_txns is not None:
+            txns = txns[:self.block_max_txns]
+        if self.block_max_bytes is not None:
+            size = 0
+            for i, txn in enumerate(txns):
+                size += txn.size()
+                if size > self.block_max_bytes:
+                    return txns[:i]
+        return txns
 
     # Create a new Block in the Blockchain
     # this is where you are supposed to create a new valid block.
@@ -233,37 +1345,286 @@ class Blockchain(object):
     #
     # :return: New Block
     # Work on constructing a valid block when it's your turn.
-    def __mine_new_block_in_thread(self, genesis=False):
-        logging.info("[MINER] waiting for new transactions before mining new block...")
-        time.sleep(self.block_mine_time)  # Wait for new transactions to come in
+    def __mine_new_block(self, genesis=False, number=None):
+        block = self.commands.call(self.__build_block, genesis, number)
+        if block is None:
+            return
+        self.__announce_block(block)
+
+    def __announce_block(self, block):
+        logging.info("[MINER] constructed new block with %d transactions. Informing others about: #%s" % (len(block.transactions), block.hash[:5]))
+        # broadcast the new block to all nodes.
+        peers = [node for node in self.nodes if node != self.node_identifier]
+        self.broadcast_block(peers, block, self.announce_relay_ids.pop(block.number, None))
+
+    # builds and commits the next block, on the applier. None if it is not block `number` (when given) anymore.
+    def __build_block(self, genesis, number=None):
         miner = self.node_identifier
         txnsWorkingSet = []
+        if number is not None and number != len(self.chain) + 1:
+            return None
 
         if genesis:
             block = Block(1, [], '0xfeedcafe', miner)
         else:
-            self.current_transactions.sort()
-
             # create a new *valid* block with available transactions. Replace the arguments in the line below.
             previousBlock = self.chain[len(self.chain) - 1]
-            txnsWorkingSet.extend(self.state.validate_txns(self.current_transactions))
-            self.current_transactions = [i for i in self.current_transactions if i not in txnsWorkingSet]
-            block = Block(previousBlock.number + 1, txnsWorkingSet, previousBlock._hash(), miner)
+            txnsWorkingSet.extend(self.__pack_block(self.mempool.ordered()))
+            block = Block(previousBlock.number + 1, txnsWorkingSet, previousBlock.hash, miner)
+            self.__take_pending(block)
 
         # make changes to in-memory data structures to reflect the new block. Check Blockchain.__init__ method for in-memory datastructures
-        self.state.apply_block(block)
-        self.chain.append(block)
-        if genesis:
-            # at time of genesis, change state to have 'A': 10000 (person A has 10000)
-            self.state.account['A'] = 10000
+        # at time of genesis, `State.apply_block` changes state to have 'A': 10000 (person A has 10000)
+        self.commit_block(block)
+        return block
 
-        logging.info("[MINER] constructed new block with %d transactions. Informing others about: #%s" % (len(block.transactions), block.hash[:5]))
-        # broadcast the new block to all nodes.
-        for node in self.nodes:
-            if node == self.node_identifier:
+    # Remove the pending copies a block built here commits. With relay, their relay ids are kept for its announcement.
+    def __take_pending(self, block):
+        self.mempool.remove(block.transactions)
+        if self.relay is not None:
+            relayIds = self.relay.take(block.transactions)
+            if relayIds is not None:
+                self.announce_relay_ids[block.number] = relayIds
+
+    # Send a block in the negotiated wire format: binary unless disabled, or the block or the peer can't handle it.
+    # With the relay ids of its transactions when given, see `TransactionRelay.commit`.
+    def broadcast_block(self, peers, block, relay_ids=None):
+        if self.wire_format == 'binary':
+            try:
+                body = block.encode_binary(relay_ids)
+            except ValueError:
+                body = None
+            if body is not None:
+                return self.transport.broadcast(peers, '/inform/block', data=body, headers={'Content-Type': WIRE_CONTENT_TYPE},
+                                                fallback=lambda: {'json': block.encode(relay_ids)})
+        return self.transport.broadcast(peers, '/inform/block', json=block.encode(relay_ids))
+
+    # Rebuild the chain and state from the block log in `directory`, then persist every later block to it.
+    # The state starts from the newest snapshot that matches the log, only later blocks are applied to it.
+    # The log only holds validated blocks, so they are not validated again.
+    def recover(self, directory, segment_bytes=64 * 1024 * 1024, sync_interval=0.005):
+        log = BlockLog(directory, segment_bytes, sync_interval)
+        started = time.monotonic()
+        for record in log.replay():
+            block = Block.decode_record(record)
+            if block.number != len(self.chain) + 1:
+                raise ValueError("block log holds block #%s where #%s was expected" % (block.number, len(self.chain) + 1))
+            self.__append_block(block)
+
+        snapshots = SnapshotStore(directory)
+        snapshot = None
+        for candidate in snapshots.load():
+            height = candidate['height']
+            if 0 < height <= len(self.chain) and self.chain[height - 1].hash == candidate['hash']:
+                snapshot = candidate
+                break
+            logging.warning("[STORAGE] snapshot at height %s does not match the block log" % height)
+        height = 0
+        if snapshot is not None:
+            height = snapshot['height']
+            self.state = State.restore(snapshot['data'])
+        for block in self.chain[height:]:
+            self.state.apply_block(block)
+        logging.info("[STORAGE] recovered %d blocks in %.3fs, %d applied after the snapshot" % (len(self.chain), time.monotonic() - started, len(self.chain) - height))
+        self.log = log
+        self.height = len(self.chain)
+
+        if self.snapshot_blocks or self.snapshot_interval:
+            shadow = State.restore(snapshot['data']) if snapshot is not None else State()
+            thread = threading.Thread(target=self.__write_snapshots, args=(snapshots, shadow, height), daemon=True)
+            thread.start()
+
+    # Snapshot writer. Keeps a private copy of the state (`shadow`, at `height`) that trails the chain, so writing a
+    # snapshot never stops the miner or request handlers.
+    def __write_snapshots(self, snapshots, shadow, height):
+        while True:
+            with self.snapshot_signal:
+                if not self.snapshot_requested:  # a request made while the last snapshot was written is not lost
+                    self.snapshot_signal.wait(self.snapshot_interval or None)
+                self.snapshot_requested = False
+            target = self.height
+            if target == height:
                 continue
-            requests.post(f'http://localhost:{node}/inform/block', json=block.encode())
+            for block in self.chain[height:target]:
+                shadow.apply_block(block)
+            height = target
+            try:
+                snapshots.write(height, self.chain[height - 1].hash, shadow.snapshot())
+                logging.info("[STORAGE] wrote state snapshot at height %d" % height)
+            except OSError:
+                logging.exception("[STORAGE] failed to write state snapshot at height %d" % height)
+
+    # Append a valid block to the chain and reflect it in the state and indexes. `changes` is the block's
+    # `State.execute` result, if the caller already has it. With a block log, the block is on disk before readers see
+    # it: without `publish`, only once the caller calls `__publish`, which makes every block since durable in one fsync.
+    def commit_block(self, block, changes=None, publish=True):
+        if changes is None:
+            changes = self.state.execute(block)
+            if changes is None:
+                raise ValueError("block #%s does not apply to the state" % block.number)
+        # everything that can fail comes before the block is written to the log or the chain
+        updates = self.state.prepare_changes(changes)
+        record = block.encode_record() if self.log is not None else None
+        txids = [txn.txid() for txn in block.transactions]
+        if self.log is not None:
+            self.log.append(record, durable=False)
+        self.__append_block(block, txids)
+        self.state.apply_changes(block, updates)
+        if publish:
+            self.__publish()
+
+    # make the committed blocks durable, then visible to readers
+    def __publish(self):
+        if self.height == len(self.chain):
+            return
+        if self.log is not None:
+            self.log.sync()
+        previous, self.height = self.height, len(self.chain)
+        if self.log is not None and self.snapshot_blocks and previous // self.snapshot_blocks < self.height // self.snapshot_blocks:
+            with self.snapshot_signal:
+                self.snapshot_requested = True
+                self.snapshot_signal.notify()
+        if self.block_max_txns is not None or self.block_max_bytes is not None:
+            self.__select_block_txns(self.mempool.ordered())  # recounts what the size triggers leave out
+        if self.pipeline_depth > 1:
+            with self.mine_signal:
+                self.mine_signal.notify()  # a due block may be waiting for this one
+
+    def __append_block(self, block, txids=None):
+        if txids is None:
+            txids = [txn.txid() for txn in block.transactions]
+        self.chain.append(block)
+        self.hash_index[block.hash] = block.number
+        for position, txid in enumerate(txids):
+            self.txn_index.setdefault(txid, []).append((block.number, position))
+
+    # Committed blocks numbered `start` to `end` (inclusive), at most `limit` of them. Returns (blocks, next) with `blocks`
+    # read lazily off the chain and `next` the number to continue from, None after the last block.
+    def blocks_page(self, start=None, end=None, limit=None):
+        height = self.height
+        start = 1 if start is None else max(start, 1)
+        end = height if end is None else min(end, height)
+        next = None
+        if limit is not None and end - start + 1 > limit:
+            end = start + limit - 1
+            next = end + 1
+        return (self.chain[number - 1] for number in range(start, end + 1)), next
+
+    # committed block by number, None if there is none
+    def block(self, number):
+        if 1 <= number <= self.height:
+            return self.chain[number - 1]
+        return None
+
+    def block_by_hash(self, block_hash):
+        number = self.hash_index.get(block_hash)
+        return None if number is None or number > self.height else self.chain[number - 1]
+
+    # The read side. Request handlers read without taking a lock, and never past `height`: what they see is the node
+    # as of a committed block, even while the applier is in the middle of the next one.
+
+    # committed blocks, up to `height` (default: the last committed one)
+    def committed_chain(self, height=None):
+        return self.chain[:self.height if height is None else height]
+
+    # (account, balance) pairs as of block `height` (default: the last committed one)
+    def committed_state(self, height=None):
+        return self.state.items(self.height if height is None else height)
+
+    # see `State.balance`, never past the last committed block
+    def balance(self, account, number=None):
+        height = self.height
+        return self.state.balance(account, height if number is None else min(number, height))
+
+    # see `State.history_page`, never past the last committed block
+    def history_page(self, account, from_block=None, to_block=None, limit=None, cursor=None):
+        height = self.height
+        to_block = height if to_block is None else min(to_block, height)
+        return self.state.history_page(account, from_block, to_block, limit, cursor)
+
+    # committed occurrences of a transaction as [(block number, position)], up to `height`
+    def occurrences(self, txid):
+        height = self.height
+        return [(number, position) for number, position in self.txn_index.get(txid, ()) if number <= height]
+
+    # Where a transaction is: its committed occurrences as [block number, block hash, position], first one first,
+    # and the number of identical copies still pending. None if the node has never seen it.
+    def transaction(self, txid):
+        occurrences = self.occurrences(txid)
+        pending = self.mempool.get(txid)
+        if occurrences:
+            number, position = occurrences[0]
+            txn = self.chain[number - 1].transactions[position]
+        elif pending is not None:
+            txn = pending
+        else:
+            return None
+        return {
+            'txid': txid,
+            'transaction': txn.encode(),
+            'blocks': [[number, self.chain[number - 1].hash, position] for number, position in occurrences],
+            'pending': self.mempool.copies.get(txid, 0),
+        }
+
+    # inclusion proof of the first committed occurrence of a transaction, None if it is not committed
+    def inclusion_proof(self, txid):
+        occurrences = self.occurrences(txid)
+        if not occurrences:
+            return None
+        number, position = occurrences[0]
+        proof = self.chain[number - 1].inclusion_proof(position)
+        proof['txid'] = txid
+        return proof
+
+    # Relay transactions submitted to this node to the next `proposers` block proposers.
+    def enable_relay(self, proposers):
+        self.relay_proposers = proposers
+        self.relay = TransactionRelay(self.transport, self.upcoming_proposers, self.node_identifier)
+
+    # the other nodes among the `relay_proposers` that propose the next blocks in Round Robin order
+    def upcoming_proposers(self):
+        height = self.height
+        if height == 0:
+            nextMinerIndex = 0
+        else:
+            nextMinerIndex = (self.nodes.index(self.chain[height - 1].miner) + 1) % len(self.nodes)
+        upcoming = [self.nodes[(nextMinerIndex + i) % len(self.nodes)] for i in range(min(self.relay_proposers, len(self.nodes)))]
+        return [node for node in upcoming if node != self.node_identifier]
 
     # Add this transaction to the transaction mempool. We will try to include this transaction in the next block until it succeeds.
     def new_transaction(self, sender, recipient, amount):
-        self.current_transactions.append(Transaction(sender, recipient, amount))
+        return self.new_transactions([Transaction(sender, recipient, amount)])[0]
+
+    # Add a batch of `Transaction`s to the mempool at once. Returns their txids.
+    # `relayed`: for transactions from another node's relay, the height of that node when it queued them, and
+    # `relay_ids` their relay ids. Copies that are pending or committed already are left out.
+    def new_transactions(self, txns, relayed=None, relay_ids=None):
+        if self.relay is not None and relayed is None:
+            relay_ids = self.relay.assign(len(txns))
+        self.commands.call_batch(self.__admit, (txns, relay_ids, relayed))
+        if self.relay is not None and relayed is None:
+            self.relay.submit(txns, relay_ids, self.height)
+        if self.block_max_txns is not None or self.block_max_bytes is not None:
+            with self.mine_signal:
+                self.mine_signal.notify()  # may reach a size trigger
+        return [txn.txid() for txn in txns]
+
+    # Adds the transactions of several `new_transactions` calls, [(txns, relay ids, relayed), ...], to the mempool in
+    # one go, on the applier.
+    def __admit(self, batches):
+        admitted = []
+        tracked = {}  # {relay id: Transaction} admitted copies with a relay id
+        for txns, relay_ids, relayed in batches:
+            if self.relay is not None and relay_ids is not None:
+                for txn, id in self.relay.admissible(txns, relay_ids, relayed):
+                    if id not in tracked:  # the same relayed batch may have been delivered twice
+                        tracked[id] = txn
+                        admitted.append(txn)
+            else:
+                admitted.extend(txns)
+        self.mempool.add_many(admitted)
+        if tracked:
+            self.relay.admitted((txn, id) for id, txn in tracked.items())
+        if self.block_max_txns is not None or self.block_max_bytes is not None:
+            self.__count_admitted(admitted)
+        return [None] * len(batches)
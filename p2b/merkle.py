@@ -0,0 +1,83 @@
+# Merkle tree over the transactions of a block, shaped like RFC 6962: the left subtree of n leaves holds the largest
+# power of two smaller than n. Leaves and inner nodes are hashed with different prefixes, so one can't pass for the other.
+import hashlib
+
+EMPTY_ROOT = hashlib.sha256(b'').digest()
+
+
+def leaf_hash(data: bytes) -> bytes:
+    return hashlib.sha256(b'\x00' + data).digest()
+
+
+def node_hash(left: bytes, right: bytes) -> bytes:
+    return hashlib.sha256(b'\x01' + left + right).digest()
+
+
+class MerkleBuilder(object):
+    # Builds the root while leaves are added one at a time. Keeps one perfect subtree root per set bit of the
+    # leaf count, so memory is O(log n) and each add costs O(1) hashes amortized.
+    def __init__(self):
+        self.count = 0
+        self.subtrees = []  # [(height, root)], heights strictly decreasing
+
+    def add(self, leaf):
+        self.count += 1
+        height = 0
+        while self.subtrees and self.subtrees[-1][0] == height:
+            left = self.subtrees.pop()[1]
+            leaf = node_hash(left, leaf)
+            height += 1
+        self.subtrees.append((height, leaf))
+
+    def root(self) -> bytes:
+        if not self.subtrees:
+            return EMPTY_ROOT
+        root = self.subtrees[-1][1]
+        for _, left in reversed(self.subtrees[:-1]):
+            root = node_hash(left, root)
+        return root
+
+
+# every level of the tree, leaves first. The last node of an odd-sized level is promoted unchanged, which gives
+# the same tree as `MerkleBuilder`.
+def merkle_levels(leaves):
+    levels = [list(leaves)]
+    while len(levels[-1]) > 1:
+        level = levels[-1]
+        parents = [node_hash(level[i], level[i + 1]) for i in range(0, len(level) - 1, 2)]
+        if len(level) % 2 == 1:
+            parents.append(level[-1])
+        levels.append(parents)
+    return levels
+
+
+# sibling hashes from the leaf at `index` up to the root, O(log n)
+def inclusion_proof(levels, index):
+    path = []
+    for level in levels[:-1]:
+        sibling = index ^ 1
+        if sibling < len(level):
+            path.append(level[sibling])
+        index //= 2
+    return path
+
+
+# check that `leaf` is leaf number `index` of a tree of `count` leaves with the given root
+def verify_inclusion(leaf, index, count, path, root) -> bool:
+    if index < 0 or index >= count:
+        return False
+    node = leaf
+    remaining = list(path)
+    size = count
+    while size > 1:
+        if index % 2 == 1:
+            if not remaining:
+                return False
+            node = node_hash(remaining.pop(0), node)
+        elif index + 1 < size:
+            if not remaining:
+                return False
+            node = node_hash(node, remaining.pop(0))
+        index //= 2
+        size = (size + 1) // 2
+    return not remaining and node == root
@@ -0,0 +1,137 @@
+import time
+import logging
+import threading
+
+# marks a /transactions/batch request as relayed by another node, so its transactions are not relayed again.
+# Its value is the height of the relaying node when it queued the oldest transaction of the batch.
+RELAY_HEADER = 'X-P2B-Relayed'
+
+
+# A relay id, [origin, sequence number] in JSON, as an (origin, sequence number) tuple. Raises ValueError if malformed.
+def decode_relay_id(value):
+    if not isinstance(value, list) or len(value) != 2 or type(value[0]) not in (int, str) or type(value[1]) is not int:
+        raise ValueError("malformed relay id %r" % (value,))
+    return value[0], value[1]
+
+
+class TransactionRelay(object):
+    # Forwards transactions submitted to this node to the nodes proposing the next blocks, in batches, so they don't
+    # wait here for this node's turn. Every submission gets its own relay id, (origin node, sequence number), that
+    # travels with its copies: identical payments submitted twice are two submissions, and a block commits one of them.
+    def __init__(self, transport, targets, origin, interval=0.02, batch=1000):
+        self.transport = transport
+        self.targets = targets  # returns the peers to forward to right now
+        self.origin = origin  # this node's identifier, the first half of the relay ids it hands out
+        self.interval = interval  # seconds transactions are collected before a batch is sent
+        self.batch = batch  # most transactions per request
+        self.lock = threading.Condition()
+        self.sequence = 0  # last relay id sequence number handed out
+        self.queue = []  # [(Transaction, relay id, height when it was queued)] waiting to be forwarded
+        self.thread = None
+        # applier only, kept in step with the mempool
+        self.pending = {}  # {txid: [relay id]} relay ids of the pending copies, oldest first
+        self.committed = {}  # {origin: {sequence number: block number}} copies committed before they arrived here
+
+    # relay ids for `count` new submissions to this node
+    def assign(self, count):
+        with self.lock:
+            first = self.sequence + 1
+            self.sequence += count
+        return [(self.origin, sequence) for sequence in range(first, first + count)]
+
+    # forward submissions to this node, which has committed `height` blocks
+    def submit(self, txns, ids, height):
+        with self.lock:
+            self.queue.extend((txn, id, height) for txn, id in zip(txns, ids))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.__forward, daemon=True)
+                self.thread.start()
+            self.lock.notify()
+
+    # The (transaction, relay id) pairs to add to the mempool: leaves out copies pending or committed already.
+    # `relayed`: for a batch from another node's relay, the height of that node when it queued the batch.
+    def admissible(self, txns, ids, relayed=None):
+        if relayed is not None and ids:
+            self.__forget_committed(ids[0][0], relayed)
+        admissible = []
+        for txn, id in zip(txns, ids):
+            if id[1] in self.committed.get(id[0], ()) or id in self.pending.get(txn.txid(), ()):
+                continue
+            admissible.append((txn, id))
+        return admissible
+
+    # the pairs of `admissible` made it into the mempool
+    def admitted(self, pairs):
+        for txn, id in pairs:
+            self.pending.setdefault(txn.txid(), []).append(id)
+
+    # Relay ids of the copies a block built here commits, in block order: the oldest pending copy of each. None if
+    # there is a copy without one.
+    def take(self, txns):
+        ids = [self.__pop(txn.txid()) for txn in txns]
+        return None if None in ids else ids
+
+    # Block `number` commits `txns` with the relay ids `ids` (None if it came without them). Returns the transactions
+    # whose copies here it committed. Copies it commits that did not arrive yet are remembered, to leave them out then.
+    # Without relay ids, the oldest copy of an identical transaction counts as committed.
+    def commit(self, number, txns, ids=None):
+        committed = []
+        for position, txn in enumerate(txns):
+            txid = txn.txid()
+            if ids is None:
+                if self.__pop(txid) is not None:
+                    committed.append(txn)
+                continue
+            id = ids[position]
+            copies = self.pending.get(txid, ())
+            if id in copies:
+                copies.remove(id)
+                if not copies:
+                    del self.pending[txid]
+                committed.append(txn)
+            else:
+                self.committed.setdefault(id[0], {})[id[1]] = number
+        return committed
+
+    def __pop(self, txid):
+        copies = self.pending.get(txid)
+        if not copies:
+            return None
+        id = copies.pop(0)
+        if not copies:
+            del self.pending[txid]
+        return id
+
+    # A batch `origin` queued at `height` arrived. Its batches come in order, and a submission is only committed after
+    # the height it was queued at: the ones committed up to `height` were in earlier batches, they won't arrive anymore.
+    def __forget_committed(self, origin, height):
+        committed = self.committed.get(origin)
+        if committed is None:
+            return
+        for sequence in [sequence for sequence, number in committed.items() if number <= height]:
+            del committed[sequence]
+        if not committed:
+            del self.committed[origin]
+
+    def __forward(self):
+        while True:
+            with self.lock:
+                while not self.queue:
+                    self.lock.wait()
+                # let more transactions join this batch
+                deadline = time.monotonic() + self.interval
+                remaining = self.interval
+                while remaining > 0 and len(self.queue) < self.batch:
+                    self.lock.wait(remaining)
+                    remaining = deadline - time.monotonic()
+                batch = self.queue[:self.batch]
+                del self.queue[:self.batch]
+            peers = self.targets()
+            if not peers:
+                continue
+            body = [dict(txn.encode(), relay_id=list(id)) for txn, id, height in batch]
+            height = min(height for txn, id, height in batch)
+            responses = self.transport.broadcast(peers, '/transactions/batch', json=body, headers={RELAY_HEADER: str(height)})
+            failed = [peer for peer, response in responses.items() if response is None or response.status_code != 201]
+            if failed:
+                logging.warning("[RELAY] %d transactions not delivered to %s" % (len(batch), failed))
@@ -1,6 +1,9 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
+import base64
+import json
 import logging
 import blockchain as bc
+from relay import RELAY_HEADER, decode_relay_id
 
 # Instantiate the Node
 app = Flask(__name__)
@@ -13,61 +16,148 @@ blockchain = bc.Blockchain()
 # Observe that it makes a call to is_new_block_valid before accepting it.
 # What all should a node do when it gets a block?
 def new_block_received():
-    values = request.get_json()
-    logging.info("Received: " + str(values))
+    if request.mimetype == bc.WIRE_CONTENT_TYPE:
+        try:
+            block, receivedHash, relayIds = bc.Block.decode_announcement(request.get_data())
+        except ValueError as e:
+            logging.warning("[RPC: inform/block] Malformed block: %s" % e)
+            return 'Malformed block', 400
+        logging.info("Received: " + str(block))
+    elif request.is_json:
+        values = request.get_json()
+        logging.info("Received: " + str(values))
 
-    # Check that the required fields are in the POST'ed data
-    required = ['number', 'transactions', 'miner', 'previous_hash', 'hash']
-    if not all(k in values for k in required):
-        logging.warning("[RPC: inform/block] Missing values")
-        return 'Missing values', 400
+        # Check that the required fields are in the POST'ed data
+        required = ['number', 'transactions', 'miner', 'previous_hash', 'hash']
+        if not all(k in values for k in required):
+            logging.warning("[RPC: inform/block] Missing values")
+            return 'Missing values', 400
+
+        try:
+            block = bc.Block.decode(values)
+            relayIds = None
+            if values.get('relay_ids') is not None:
+                relayIds = [decode_relay_id(id) for id in values['relay_ids']]
+                if len(relayIds) != len(block.transactions):
+                    raise ValueError("%d relay ids for %d transactions" % (len(relayIds), len(block.transactions)))
+        except ValueError as e:
+            logging.warning("[RPC: inform/block] Malformed block: %s" % e)
+            return 'Malformed block', 400
+        receivedHash = values['hash']
+    else:
+        return 'Unsupported content type', 415
 
-    block = bc.Block.decode(values)
-    valid = blockchain.is_new_block_valid(block, values['hash'])
+    # blocks before it have not arrived (yet): it waits for them in the block buffer
+    if blockchain.buffer_if_ahead(block, receivedHash, relayIds):
+        return 'Block ahead of chain, buffered', 202
+
+    # Add the block to the chain, and modify any other in-memory data structures to reflect the new block
+    valid = blockchain.receive_block(block, receivedHash, relayIds)
 
     if not valid:
         logging.warning("[RPC: inform/block] Invalid block")
         return 'Invalid block', 400
 
-    blockchain.chain.append(block)    # Add the block to the chain
-    # Modify any other in-memory data structures to reflect the new block
-    blockchain.state.apply_block(block)
-
     # if I am responsible for next block, start mining it (trigger_new_block_mine).
-    # make nodes propose blocks in Round Roubin  fashion
-    nodesNumber = len(blockchain.nodes)
-    lastCommitedBlock = blockchain.chain[len(blockchain.chain) - 1]
-    previousMiner = lastCommitedBlock.miner
-    previousMinerNodeIndex = blockchain.nodes.index(previousMiner)
-    nextMinerIndex = (previousMinerNodeIndex + 1) % nodesNumber
-    nextMinerIdentifier = blockchain.nodes[nextMinerIndex]
-
-    if (blockchain.node_identifier == nextMinerIdentifier):
-        blockchain.trigger_new_block_mine()  # mine the block
+    blockchain.mine_if_next()
 
     return "OK", 201
 
 
 @app.route('/transactions/new', methods=['POST'])
 def new_transaction():
-    values = request.get_json()
+    if request.mimetype == bc.WIRE_CONTENT_TYPE:
+        try:
+            values = bc.Transaction.decode_binary(request.get_data()).encode()
+        except ValueError:
+            return 'Malformed transaction', 400
+    elif request.is_json:
+        values = request.get_json()
+    else:
+        return 'Unsupported content type', 415
+
+    txn, error = parse_transaction(values)
+    if txn is None:
+        return error, 400
 
+    # Create a new Transaction
+    blockchain.new_transaction(txn.sender, txn.recipient, txn.amount)
+    return "OK", 201
+
+
+# `Transaction` of submitted {"sender", "recipient", "amount"} values, or None and the reason it is rejected
+def parse_transaction(values):
+    if not isinstance(values, dict):
+        return None, 'Malformed transaction'
     # Check that the required fields are in the POST'ed data
     required = ['sender', 'recipient', 'amount']
     if not all(k in values for k in required):
-        return 'Missing values', 400
+        return None, 'Missing values'
+    if not isinstance(values['sender'], str) or not isinstance(values['recipient'], str):
+        return None, 'Invalid values'
+    try:
+        amount = int(values['amount'])
+    except (TypeError, ValueError, OverflowError):
+        return None, 'Invalid values'
+    return bc.Transaction(values['sender'], values['recipient'], amount), None
 
-    # Create a new Transaction
-    blockchain.new_transaction(values['sender'], values['recipient'], int(values['amount']))
-    return "OK", 201
+
+@app.route('/transactions/batch', methods=['POST'])
+# A JSON array of transactions, or NDJSON with one per line. Every well-formed entry is added to the mempool in one go.
+# Batches from another node's `TransactionRelay` carry the RELAY_HEADER.
+# {"accepted": <count>, "results": [{"txid": <id>} or {"error": <reason>}]} with one result per entry, in order.
+def new_transactions():
+    if request.mimetype == NDJSON_MIMETYPE:
+        entries = []
+        for line in request.get_data().splitlines():
+            if line.strip() == b'':
+                continue
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                entries.append(None)
+    elif request.is_json:
+        entries = request.get_json(silent=True)
+        if not isinstance(entries, list):
+            return 'Malformed batch', 400
+    else:
+        return 'Unsupported content type', 415
+
+    relayed = request.headers.get(RELAY_HEADER)
+    if relayed is not None:
+        try:
+            relayed = int(relayed)
+        except ValueError:
+            return 'Invalid values', 400
+
+    results = []
+    txns = []
+    relayIds = [] if relayed is not None else None  # relayed entries carry the relay id of their submission
+    for values in entries:
+        txn, error = parse_transaction(values)
+        if txn is not None and relayIds is not None:
+            try:
+                relayIds.append(decode_relay_id(values.get('relay_id')))
+            except ValueError:
+                txn, error = None, 'Invalid values'
+        if txn is None:
+            results.append({'error': error})
+            continue
+        txns.append(txn)
+        results.append(None)
+
+    txids = iter(blockchain.new_transactions(txns, relayed=relayed, relay_ids=relayIds))
+    results = [{'txid': next(txids)} if result is None else result for result in results]
+    return jsonify({'accepted': len(txns), 'results': results}), 201
 
 
 @app.route('/dump', methods=['GET'])
 def full_chain():
+    height = blockchain.height  # chain and state as of the same block
     response = {
-        'chain': [b.encode() for b in blockchain.chain],
-        'pending_transactions': [txn.encode() for txn in sorted(blockchain.current_transactions)],
-        'state': blockchain.state.encode()
+        'chain': [b.encode() for b in blockchain.committed_chain(height)],
+        'pending_transactions': [txn.encode() for txn in blockchain.mempool.ordered()],
+        'state': dict(blockchain.committed_state(height))
     }
     return jsonify(response), 200
 
@@ -84,13 +174,196 @@ def health():
     return 'OK', 200
 
 
+@app.route('/peers', methods=['GET'])
+def peers():
+    return jsonify(blockchain.transport.encode_stats()), 200
+
+
+@app.route('/balance', methods=['GET'])
+def balance():
+    account = request.args.get('account', '')
+    if account == '':
+        return 'Missing values', 400
+    number = request.args.get('block')
+    if number is not None:
+        try:
+            number = int(number)
+        except ValueError:
+            return 'Invalid values', 400
+    data = {'account': account, 'block': number, 'balance': blockchain.balance(account, number)}
+    return jsonify(data), 200
+
+
+@app.route('/proof', methods=['GET'])
+def proof():
+    txid = request.args.get('txid', '')
+    if txid == '':
+        return 'Missing values', 400
+    try:
+        data = blockchain.inclusion_proof(txid)
+    except ValueError as e:
+        return str(e), 404
+    if data is None:
+        return 'Transaction not committed', 404
+    return jsonify(data), 200
+
+
+NDJSON_MIMETYPE = 'application/x-ndjson'
+BLOCKS_PAGE_LIMIT = 100  # blocks per /blocks page when no limit is given
+
+
+@app.route('/block/<int:number>', methods=['GET'])
+def block_by_number(number):
+    block = blockchain.block(number)
+    if block is None:
+        return 'Block not found', 404
+    return jsonify(block.encode()), 200
+
+
+@app.route('/block/hash/<block_hash>', methods=['GET'])
+def block_by_hash(block_hash):
+    block = blockchain.block_by_hash(block_hash)
+    if block is None:
+        return 'Block not found', 404
+    return jsonify(block.encode()), 200
+
+
+@app.route('/tx/<txid>', methods=['GET'])
+# {"txid", "transaction", "blocks": [[block number, block hash, position]], "pending": <pending copies>}
+def transaction(txid):
+    data = blockchain.transaction(txid)
+    if data is None:
+        return 'Transaction not found', 404
+    return jsonify(data), 200
+
+
+# the integer query arguments among `names` that are present, None if one of them is not an integer
+def int_args(names):
+    values = {}
+    for name in names:
+        if name in request.args:
+            try:
+                values[name] = int(request.args[name])
+            except ValueError:
+                return None
+    return values
+
+
+# JSON array written out in chunks while `items` is consumed. With brackets='{}' and an `encode` that returns
+# '"key": value' members, a JSON object.
+def stream_json_array(items, chunk=1000, brackets='[]', encode=json.dumps):
+    yield brackets[0]
+    batch = []
+    first = True
+    for item in items:
+        batch.append(encode(item))
+        if len(batch) == chunk:
+            yield ('' if first else ',') + ','.join(batch)
+            first = False
+            batch = []
+    if batch:
+        yield ('' if first else ',') + ','.join(batch)
+    yield brackets[1]
+
+
+# {"<key>": [...], "next": <cursor of the next page or null>}
+def stream_json_page(key, items, next):
+    yield '{%s: ' % json.dumps(key)
+    yield from stream_json_array(items)
+    yield ', "next": %s}' % json.dumps(next)
+
+
+# one JSON document per line, each written as soon as it is encoded
+def stream_ndjson(items):
+    for item in items:
+        yield json.dumps(item) + '\n'
+
+
 @app.route('/history', methods=['GET'])
+# Without paging arguments: the whole history as a list of [block number, amount].
+# With any of from_block, to_block, limit or cursor: {"history": [...], "next": <cursor of the next page or null>}.
 def history():
     account = request.args.get('account', '')
     if account == '':
         return 'Missing values', 400
-    data = blockchain.state.history(account)
-    return jsonify(data), 200
+
+    paging = int_args(['from_block', 'to_block', 'limit', 'cursor'])
+    if paging is None or paging.get('limit', 1) < 1 or paging.get('cursor', 0) < 0:
+        return 'Invalid values', 400
+
+    entries, next = blockchain.history_page(account, **paging)
+    if not paging:
+        return Response(stream_json_array(entries), mimetype='application/json'), 200
+    return Response(stream_json_page('history', entries, next), mimetype='application/json'), 200
+
+
+@app.route('/blocks', methods=['GET'])
+# Committed blocks numbered from to `to` (both inclusive, default: all of them), encoded as in /dump.
+# {"blocks": [...], "next": <from of the next page or null>} of at most limit (default BLOCKS_PAGE_LIMIT) blocks.
+# With format=ndjson: one block per line, unlimited unless limit is given. The next page is in the X-Next header.
+# With format=binary: like ndjson, as a `bc.encode_block_stream`, limit still defaults to BLOCKS_PAGE_LIMIT.
+def blocks():
+    paging = int_args(['from', 'to', 'limit'])
+    if paging is None or paging.get('limit', 1) < 1:
+        return 'Invalid values', 400
+
+    ndjson = request.args.get('format') == 'ndjson'
+    limit = paging.get('limit', None if ndjson else BLOCKS_PAGE_LIMIT)
+    blocks, next = blockchain.blocks_page(paging.get('from'), paging.get('to'), limit)
+    encoded = (block.encode() for block in blocks)
+    headers = {} if next is None else {'X-Next': str(next)}
+    if request.args.get('format') == 'binary':
+        return Response(bc.encode_block_stream(blocks), mimetype=bc.WIRE_CONTENT_TYPE, headers=headers), 200
+    if ndjson:
+        return Response(stream_ndjson(encoded), mimetype=NDJSON_MIMETYPE, headers=headers), 200
+    return Response(stream_json_page('blocks', encoded, next), mimetype='application/json'), 200
+
+
+@app.route('/state', methods=['GET'])
+# {"account-id": <balance>} of every account, as in /dump
+def state():
+    def member(item):
+        account, amount = item
+        return '%s: %d' % (json.dumps(account if isinstance(account, str) else str(account)), amount)
+    items = blockchain.committed_state()
+    return Response(stream_json_array(items, brackets='{}', encode=member), mimetype='application/json'), 200
+
+
+# opaque /mempool cursor over the (sender, recipient, amount, copy) that ends a page, see `Mempool.page`
+def encode_mempool_cursor(after):
+    return None if after is None else base64.urlsafe_b64encode(json.dumps(after).encode('utf-8')).decode('ascii')
+
+
+# None if `cursor` is not one of `encode_mempool_cursor`
+def decode_mempool_cursor(cursor):
+    try:
+        sender, recipient, amount, copy = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except (ValueError, TypeError):
+        return None
+    if type(sender) is not str or type(recipient) is not str or type(amount) is not int or type(copy) is not int or copy < 0:
+        return None
+    return sender, recipient, amount, copy
+
+
+@app.route('/mempool', methods=['GET'])
+# Pending transactions in the order of /dump. Without paging arguments a list,
+# with limit and/or cursor: {"pending_transactions": [...], "next": <cursor of the next page or null>}.
+def mempool():
+    paging = int_args(['limit'])
+    if paging is None or paging.get('limit', 1) < 1:
+        return 'Invalid values', 400
+    after = None
+    if 'cursor' in request.args:
+        after = decode_mempool_cursor(request.args['cursor'])
+        if after is None:
+            return 'Invalid values', 400
+
+    if not paging and after is None:
+        encoded = (txn.encode() for txn in blockchain.mempool.ordered())
+        return Response(stream_json_array(encoded), mimetype='application/json'), 200
+    txns, next = blockchain.mempool.page(paging.get('limit'), after)
+    encoded = (txn.encode() for txn in txns)
+    return Response(stream_json_page('pending_transactions', encoded, encode_mempool_cursor(next)), mimetype='application/json'), 200
 
 
 if __name__ == '__main__':
@@ -99,17 +372,59 @@ if __name__ == '__main__':
 
     parser = ArgumentParser()
     parser.add_argument('-p', '--port', default=5000, type=int, help='port to listen on')
-    parser.add_argument('-t', '--blocktime', default=5, type=int, help='Transaction collection time (in seconds) before creating a new block.')
+    parser.add_argument('-t', '--blocktime', default=5, type=int, help='Transaction collection time (in seconds) before creating a new block. Deadline when size triggers are set.')
+    parser.add_argument('--block-min-time', default=0, type=float, help='Minimum time (in seconds) before creating a new block, even if a size trigger is reached.')
+    parser.add_argument('--block-max-txns', default=None, type=int, help='Create a block as soon as this many transactions are pending. Also the maximum number of transactions per block.')
+    parser.add_argument('--block-max-bytes', default=None, type=int, help='Create a block as soon as this many bytes of transactions are pending. Also the maximum block size.')
+    parser.add_argument('--packing', default='fixpoint', choices=['fixpoint', 'sequential'], help='Block packing: retry transactions enabled by earlier ones in the same block (fixpoint), or a single ordered pass (sequential).')
+    parser.add_argument('--wire', default='binary', choices=['binary', 'json'], help='Encoding of blocks sent to other nodes. Nodes that do not support binary get JSON.')
+    parser.add_argument('--peer-timeout', default=2.0, type=float, help='Timeout (in seconds) of a single request to another node.')
+    parser.add_argument('--peer-retries', default=2, type=int, help='Extra attempts when a request to another node fails.')
+    parser.add_argument('--datadir', default=None, help='Directory of the on-disk block log. The chain is recovered from it on startup. In memory only if not set.')
+    parser.add_argument('--log-segment-bytes', default=64 * 1024 * 1024, type=int, help='Size (in bytes) at which the block log starts a new segment.')
+    parser.add_argument('--log-sync-interval', default=0.005, type=float, help='Time (in seconds) the block log waits to batch appends into one fsync.')
+    parser.add_argument('--snapshot-blocks', default=1000, type=int, help='With --datadir, write a state snapshot every this many blocks (0: never).')
+    parser.add_argument('--snapshot-interval', default=300, type=float, help='With --datadir, write a state snapshot every this many seconds (0: never).')
+    parser.add_argument('--block-buffer', default=64, type=int, help='Blocks received ahead of the chain that are held until the gap closes.')
+    parser.add_argument('--block-buffer-wait', default=1.0, type=float, help='Time (in seconds) a gap before a held block may stay open before catching up from the other nodes.')
+    parser.add_argument('--relay', default=0, type=int, help='Relay submitted transactions to this many upcoming block proposers (0: keep them until this node proposes).')
+    parser.add_argument('--sync-batch', default=500, type=int, help='Blocks fetched per request when catching up with another node.')
+    parser.add_argument('--pipeline-depth', default=1, type=int, help='Start the block time of a block this node proposes once the block this many before it is committed. A block whose time is up is built as soon as the block before it arrives (1: no pipelining).')
+    parser.add_argument('--runtime', default='flask', choices=['flask', 'asyncio'], help='HTTP runtime: the Flask development server, or an asyncio event loop (needs aiohttp).')
     parser.add_argument('-n', '--nodes', nargs='+', help='ports of all participating nodes (space separated). e.g. -n 5001 5002 5003', required=True)
 
     args = parser.parse_args()
+    if args.block_buffer < 1:
+        parser.error('--block-buffer must be at least 1')
 
     # Use port as node identifier.
     port = args.port
     blockchain.node_identifier = port
     blockchain.block_mine_time = args.blocktime
+    blockchain.block_min_time = args.block_min_time
+    blockchain.block_max_txns = args.block_max_txns
+    blockchain.block_max_bytes = args.block_max_bytes
+    blockchain.block_packing = args.packing
+    blockchain.wire_format = args.wire
+    blockchain.transport.timeout = args.peer_timeout
+    blockchain.transport.retries = args.peer_retries
+    blockchain.sync_batch_blocks = args.sync_batch
+    blockchain.pipeline_depth = max(args.pipeline_depth, 1)
+    blockchain.block_buffer.capacity = args.block_buffer
+    blockchain.block_buffer_wait = args.block_buffer_wait
+    if args.relay > 0:
+        blockchain.enable_relay(args.relay)
 
     for nodeport in args.nodes:
         blockchain.nodes.append(int(nodeport))
 
-    app.run(host='0.0.0.0', port=port)
+    if args.datadir is not None:
+        blockchain.snapshot_blocks = args.snapshot_blocks
+        blockchain.snapshot_interval = args.snapshot_interval
+        blockchain.recover(args.datadir, args.log_segment_bytes, args.log_sync_interval)
+
+    if args.runtime == 'asyncio':
+        import aioserver
+        aioserver.run(app, port)
+    else:
+        app.run(host='0.0.0.0', port=port)
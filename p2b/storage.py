@@ -0,0 +1,175 @@
+# On-disk persistence of the chain.
+import os
+import json
+import mmap
+import zlib
+import time
+import struct
+import logging
+import threading
+
+# record: u32 payload length, u32 crc32 of the payload, payload
+_RECORD = struct.Struct('<II')
+
+
+class BlockLog(object):
+    # Segmented append-only log of block records. Appends are made durable by a flusher thread that fsyncs every
+    # pending record in one go (group commit). A torn or corrupt tail, e.g. after a crash, is cut off on replay.
+    def __init__(self, directory, segment_bytes=64 * 1024 * 1024, sync_interval=0.005):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.segment_bytes = segment_bytes  # start a new segment once the current one is this large
+        self.sync_interval = sync_interval  # seconds the flusher waits for more appends before an fsync
+        self.lock = threading.Condition()
+        self.segment = None  # last segment, open for appending
+        self.written = 0  # records appended
+        self.synced = 0  # records known to be on disk
+        self.flusher = None
+        self.closed = False
+
+    def segments(self):
+        names = sorted(name for name in os.listdir(self.directory) if name.startswith('segment-') and name.endswith('.log'))
+        return [os.path.join(self.directory, name) for name in names]
+
+    # Yields every intact record payload in order. Stops at the first torn or corrupt record, truncates the log there
+    # and removes the segments after it: a block is useless without the ones before it.
+    def replay(self):
+        paths = self.segments()
+        for i, path in enumerate(paths):
+            with open(path, 'rb') as f:
+                size = os.fstat(f.fileno()).st_size
+                offset = 0
+                if size > 0:
+                    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                        while offset < size:
+                            payload = self.__read(data, offset, size)
+                            if payload is None:
+                                break
+                            yield payload
+                            offset += _RECORD.size + len(payload)
+            if offset < size:
+                logging.warning("[STORAGE] corrupt record in %s at offset %d, truncating the log there" % (path, offset))
+                with open(path, 'r+b') as f:
+                    f.truncate(offset)
+                for later in paths[i + 1:]:
+                    os.remove(later)
+                return
+
+    @staticmethod
+    def __read(data, offset, size):
+        if offset + _RECORD.size > size:
+            return None
+        length, checksum = _RECORD.unpack_from(data, offset)
+        start = offset + _RECORD.size
+        if start + length > size:
+            return None
+        payload = data[start:start + length]
+        if zlib.crc32(payload) != checksum:
+            return None
+        return payload
+
+    def __open_segment(self):
+        paths = self.segments()
+        if paths and os.path.getsize(paths[-1]) < self.segment_bytes:
+            path = paths[-1]
+        else:
+            path = os.path.join(self.directory, 'segment-%08d.log' % len(paths))
+        self.segment = open(path, 'ab')
+
+    # Appends one record. With `durable`, returns once it is on disk.
+    def append(self, payload, durable=True):
+        record = _RECORD.pack(len(payload), zlib.crc32(payload)) + payload
+        with self.lock:
+            if self.segment is None:
+                self.__open_segment()
+                self.flusher = threading.Thread(target=self.__flush, daemon=True)
+                self.flusher.start()
+            elif self.segment.tell() >= self.segment_bytes:
+                self.__sync()
+                self.segment.close()
+                self.__open_segment()
+            self.segment.write(record)
+            self.written += 1
+            sequence = self.written
+            self.lock.notify_all()
+            while durable and self.synced < sequence:
+                self.lock.wait()
+
+    # Make every appended record durable now. A single writer that appends a batch with durable=False and then syncs
+    # pays one fsync, without waiting for the flusher.
+    def sync(self):
+        with self.lock:
+            if self.segment is not None and self.synced < self.written:
+                self.__sync()
+
+    # caller holds the lock
+    def __sync(self):
+        self.segment.flush()
+        os.fsync(self.segment.fileno())
+        self.synced = self.written
+        self.lock.notify_all()
+
+    def __flush(self):
+        with self.lock:
+            while not self.closed:
+                if self.synced == self.written:
+                    self.lock.wait()
+                    continue
+                # let more appends join this fsync
+                deadline = time.monotonic() + self.sync_interval
+                remaining = self.sync_interval
+                while remaining > 0 and not self.closed:
+                    self.lock.wait(remaining)
+                    remaining = deadline - time.monotonic()
+                if self.segment is not None:
+                    self.__sync()
+
+    def close(self):
+        with self.lock:
+            if self.segment is not None:
+                self.__sync()
+                self.segment.close()
+                self.segment = None
+            self.closed = True
+            self.lock.notify_all()
+
+
+class SnapshotStore(object):
+    # Point-in-time copies of the state, tagged with the height and hash of the last block they include.
+    # A snapshot file is a `_RECORD` header followed by zlib compressed JSON, written to a temporary file and renamed,
+    # so a crash never leaves a half-written snapshot behind under its final name.
+    def __init__(self, directory, keep=2):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.keep = keep  # number of snapshots kept, older ones are deleted
+
+    # snapshot files, oldest first
+    def paths(self):
+        names = sorted(name for name in os.listdir(self.directory) if name.startswith('snapshot-') and name.endswith('.snap'))
+        return [os.path.join(self.directory, name) for name in names]
+
+    def write(self, height, block_hash, data):
+        payload = zlib.compress(json.dumps({'height': height, 'hash': block_hash, 'data': data}).encode('utf-8'))
+        path = os.path.join(self.directory, 'snapshot-%012d.snap' % height)
+        temporary = path + '.tmp'
+        with open(temporary, 'wb') as f:
+            f.write(_RECORD.pack(len(payload), zlib.crc32(payload)) + payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, path)
+        for old in self.paths()[:-self.keep]:
+            os.remove(old)
+
+    # Yields intact snapshots ({'height', 'hash', 'data'}), newest first. Corrupt ones are skipped.
+    def load(self):
+        for path in reversed(self.paths()):
+            try:
+                with open(path, 'rb') as f:
+                    raw = f.read()
+                length, checksum = _RECORD.unpack_from(raw, 0)
+                payload = raw[_RECORD.size:]
+                if len(payload) != length or zlib.crc32(payload) != checksum:
+                    raise ValueError("checksum mismatch")
+                yield json.loads(zlib.decompress(payload))
+            except (OSError, ValueError, struct.error, zlib.error) as e:
+                logging.warning("[STORAGE] skipping snapshot %s: %s" % (path, e))
@@ -1,8 +1,11 @@
 import unittest
+import json
 import signal
 import os
 import time
 import random
+import shutil
+import tempfile
 import subprocess
 import requests
 
@@ -36,6 +39,8 @@ def log(msg, level='INFO'):
 
 
 server_ports = [5001, 5002, 5003]
+# HTTP runtime of the nodes, e.g. `P2B_RUNTIME=asyncio python3 testp2b.py` runs the suite against the asyncio one
+SERVER_RUNTIME = os.environ.get('P2B_RUNTIME', 'flask')
 
 BLOCK_COMMIT_TIME = 2
 POINTS = 0
@@ -74,7 +79,8 @@ class ServerProcess:
         if os.path.isfile(fname):
             os.remove(fname)
 
-    def restart(self, block_commit_time=4):
+    # `flags`: extra server.py arguments
+    def restart(self, block_commit_time=4, flags=()):
         assert (block_commit_time % 2 == 0)
         self.kill_if_running()
         if self.instance is not None:
@@ -89,8 +95,11 @@ class ServerProcess:
             args = [
                 'python3', './server.py',
                 '-p', str(self.portnumber),
-                '-t', str(block_commit_time),
-                '-n']
+                '-t', str(block_commit_time)]
+            if SERVER_RUNTIME != 'flask':
+                args.extend(['--runtime', SERVER_RUNTIME])
+            args.extend(flags)
+            args.append('-n')
             args.extend([str(x) for x in server_ports])
 
             # process = subprocess.Popen(args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
@@ -104,10 +113,22 @@ class ServerProcess:
 
             if process.poll() is None:
                 self.instance = process
+                if SERVER_RUNTIME != 'flask':
+                    self.wait_ready()
                 break
         else:
             raise Exception("Unable to start the server. 99% of the time it means that your server crashed as soon as it started. Please check manually. 1% of the time it could be due to overloaded CSL machines, please try again in 10 seconds. This is almost never the case.")
 
+    # other runtimes take longer to import than the 0.5s above
+    def wait_ready(self, seconds=3):
+        deadline = time.time() + seconds
+        while time.time() < deadline:
+            try:
+                requests.get(self.base_url + '/health', timeout=0.2)
+                return
+            except requests.exceptions.RequestException:
+                time.sleep(0.02)
+
     def check_process_alive(self):
         if self.instance is None:
             return False
@@ -129,6 +150,11 @@ class ServerProcess:
             r = requests.post(self.base_url + '/transactions/new', json=txn)
             return r.status_code == 201
 
+    def send_batch(self, txns):
+        with test_timeout(1):
+            r = requests.post(self.base_url + '/transactions/batch', json=txns)
+            return r.json()
+
     def send_block(self, block):
         with test_timeout(1):
             r = requests.post(self.base_url + '/inform/block', json=block)
@@ -149,12 +175,57 @@ class ServerProcess:
             r = requests.get(self.base_url + '/history', params={'account': account})
             return r.json()
 
+    def history_page(self, account, **paging):
+        with test_timeout(1):
+            r = requests.get(self.base_url + '/history', params=dict(paging, account=account))
+            return r.json()
+
+    def balance(self, account, block=None):
+        with test_timeout(1):
+            params = {'account': account}
+            if block is not None:
+                params['block'] = block
+            r = requests.get(self.base_url + '/balance', params=params)
+            return r.json()['balance']
+
+    def proof(self, txid):
+        with test_timeout(1):
+            r = requests.get(self.base_url + '/proof', params={'txid': txid})
+            return r.json() if r.status_code == 200 else None
+
+    def get_json(self, path, **params):
+        with test_timeout(1):
+            r = requests.get(self.base_url + path, params=params)
+            return r.json()
+
+    def lookup(self, path):
+        with test_timeout(1):
+            r = requests.get(self.base_url + path)
+            return r.json() if r.status_code == 200 else None
+
+    def blocks_ndjson(self, **params):
+        with test_timeout(1):
+            r = requests.get(self.base_url + '/blocks', params=dict(params, format='ndjson'))
+            return [json.loads(line) for line in r.text.splitlines()], r.headers.get('X-Next')
+
 
 class TestsUtils():
     @staticmethod
     def txn(sender, recipient, amount):
         return {'sender': sender, 'recipient': recipient, 'amount': amount}
 
+    @staticmethod
+    def txid(txn):
+        import hashlib
+        import struct
+
+        def scalar(value):  # string account ids and 64 bit amounts, as in the server's preimage
+            if isinstance(value, str):
+                raw = value.encode('utf-8')
+                return b's' + struct.pack('<I', len(raw)) + raw
+            return b'i' + struct.pack('<q', value)
+        return hashlib.sha256(scalar(txn['sender']) + scalar(txn['recipient']) + scalar(txn['amount'])).hexdigest()
+
     @staticmethod
     def block(num, txns, prev, miner, hash=None):
         def tx_stringify(t):
@@ -179,6 +250,18 @@ class TestsUtils():
     def checkStateEqualForAll(tst, state1, state2, state3):
         tst.assertTrue(state1 == state2 == state3)
 
+    # all nodes have the same chain and state, and every payment committed exactly once
+    @staticmethod
+    def checkAllCommitted(tst, nodes, payments):
+        dumps = [node.dump() for node in nodes]
+        TestsUtils.checkChainEqualForAll(tst, dumps[0]['chain'], dumps[1]['chain'], dumps[2]['chain'])
+        TestsUtils.checkStateEqualForAll(tst, dumps[0]['state'], dumps[1]['state'], dumps[2]['state'])
+        for dump in dumps:
+            tst.assertTrue(dump['pending_transactions'] == [])
+        committed = [txn for block in dumps[0]['chain'] for txn in block['transactions']]
+        byContent = lambda txn: json.dumps(txn, sort_keys=True)
+        tst.assertTrue(sorted(committed, key=byContent) == sorted(payments, key=byContent))
+
     @staticmethod
     def checkBlockBasic(tst, block, expectedBlockNumber, expectedMiner, expectedPrevHash=None):
         tst.assertTrue(block['number'] == expectedBlockNumber)
@@ -289,6 +372,16 @@ class Test2TxnStateSimple(unittest.TestCase):
         global POINTS
         POINTS += 2
 
+    def test_b_txn_batches_are_accepted(self):
+        txns = [TestsUtils.txn('s-%d' % i, 'r-%d' % i, i) for i in range(10)]
+        malformed = [{'sender': 's'}, 'garbage', TestsUtils.txn({}, 'r', 1), TestsUtils.txn(7, 'r', 1)]
+        result = self.nodes[0].send_batch(txns[:5] + malformed + txns[5:])
+        self.assertTrue(result['accepted'] == 10)
+        self.assertTrue([r.get('txid') for r in result['results']] == [TestsUtils.txid(t) for t in txns[:5]] + [None] * 4 + [TestsUtils.txid(t) for t in txns[5:]])
+        self.assertTrue(result['results'][5] == {'error': 'Missing values'})
+        self.assertTrue(result['results'][8] == {'error': 'Invalid values'})
+        self.assertTrue(txns == self.nodes[0].dump()['pending_transactions'])
+
     def test_e_basic_txns_are_committed(self):
         # Start and stagger
         self.nodes[0].genesis()
@@ -484,12 +577,10 @@ class Tests3UpdateableState(unittest.TestCase):
         dumps = [n.dump() for n in self.nodes]
         TestsUtils.checkChainEqualForAll(self, *[d['chain'] for d in dumps])
         TestsUtils.checkStateEqualForAll(self, *[d['state'] for d in dumps])
-        self.assertTrue(dumps[1]['pending_transactions'] == [TestsUtils.txn('A', 'D', 6500)])
-        self.assertTrue(dumps[1]['state'] == {'A': 6500, 'B': 3000, 'C': 500})
-        self.assertTrue(dumps[1]['chain'][-1]['transactions'] == [TestsUtils.txn('A', 'B', 4000), TestsUtils.txn('B', 'C', 1000), TestsUtils.txn('C', 'A', 500)])
-        # We don't expect you to make multiple passes to check which all transactions go in. That becomes an algorithmically hard problem.
-        # Systemsy way to solve this is pick an ordering, validate txns based on ordering. And then retry during next block mining. Eventually, txn will commit
-        # Also, in real world systems, such a transaction is available with multiple nodes all of whom will be trying to include it in their block.
+        self.assertTrue(dumps[1]['pending_transactions'] == [])
+        self.assertTrue(dumps[1]['state'] == {'A': 0, 'B': 3000, 'C': 500, 'D': 6500})
+        # A -> D only becomes valid once C -> A is applied. Block packing retries it within the same block.
+        self.assertTrue(dumps[1]['chain'][-1]['transactions'] == [TestsUtils.txn('A', 'B', 4000), TestsUtils.txn('B', 'C', 1000), TestsUtils.txn('C', 'A', 500), TestsUtils.txn('A', 'D', 6500)])
 
         commit()  # 2
         commit()  # 0
@@ -500,7 +591,7 @@ class Tests3UpdateableState(unittest.TestCase):
         TestsUtils.checkStateEqualForAll(self, *[d['state'] for d in dumps])
         self.assertTrue(dumps[1]['pending_transactions'] == [])
         self.assertTrue(dumps[1]['state'] == {'A': 0, 'B': 3000, 'C': 500, 'D': 6500})
-        self.assertTrue(dumps[1]['chain'][-1]['transactions'] == [TestsUtils.txn('A', 'D', 6500)])
+        self.assertTrue(dumps[1]['chain'][-1]['transactions'] == [])
 
         global POINTS
         POINTS += 7
@@ -667,6 +758,57 @@ class Tests4SemanticValidations(unittest.TestCase):
         global POINTS
         POINTS += 4
 
+    def test_k_out_of_range_amounts(self):
+        self.nodes[0].genesis()
+        stagger()
+        commit()
+
+        # balances are 64 bit: neither a block nor a proposer may take one out of range
+        prev = self.nodes[0].dump()['chain'][-1]['hash']
+        block = TestsUtils.block(2, [TestsUtils.txn('A', 'B', -2 ** 63)], prev, server_ports[1])
+        self.assertFalse(self.nodes[0].send_block(block))
+        self.nodes[1].send_txn(TestsUtils.txn('A', 'B', -2 ** 63))
+        self.nodes[1].send_txn(TestsUtils.txn('A', 'B', 2 ** 63))
+        self.nodes[1].send_txn(TestsUtils.txn('A', 'C', 10))
+        commit()
+
+        dumps = [node.dump() for node in self.nodes]
+        TestsUtils.checkChainEqualForAll(self, dumps[0]['chain'], dumps[1]['chain'], dumps[2]['chain'])
+        self.assertTrue(len(dumps[0]['chain']) == 2)
+        self.assertTrue(dumps[0]['chain'][1]['transactions'] == [TestsUtils.txn('A', 'C', 10)])
+        self.assertTrue(dumps[0]['state'] == {'A': 9990, 'C': 10})
+
+    def test_l_unfunded_txns_dont_trigger_blocks(self):
+        for node in self.nodes:
+            node.kill_if_running()
+            node.instance = None
+            node.restart(BLOCK_COMMIT_TIME, ['--block-max-txns', '2'])
+        self.nodes[0].genesis()
+        stagger()
+        commit()
+
+        # these can never be funded, a full mempool of them must not make blocks due at once
+        for node in self.nodes:
+            for i in range(3):
+                node.send_txn(TestsUtils.txn('X', 'Y', i + 1))
+        commit()
+
+        dumps = [node.dump() for node in self.nodes]
+        self.assertTrue(len(dumps[0]['chain']) <= 3)
+        self.assertTrue(dumps[0]['state'] == {'A': 10000})
+
+    def test_m_unknown_block_version(self):
+        self.nodes[0].genesis()
+        stagger()
+        commit()
+
+        prev = self.nodes[0].dump()['chain'][-1]['hash']
+        for version in ['3', 4, None]:
+            block = dict(TestsUtils.block(2, [], prev, server_ports[1]), version=version)
+            r = requests.post(self.nodes[0].base_url + '/inform/block', json=block)
+            self.assertTrue(r.status_code == 400)
+        self.assertTrue(len(self.nodes[0].dump()['chain']) == 1)
+
 
 class Tests5History(unittest.TestCase):
     def setUp(self):
@@ -762,6 +904,410 @@ class Tests5History(unittest.TestCase):
         global POINTS
         POINTS += 10
 
+    def test_g_history_pages(self):
+        self.nodes[0].genesis()
+        stagger()
+        commit()  # 0
+
+        for blocknumber in range(2, 7):
+            self.nodes[(blocknumber - 1) % len(self.nodes)].send_txn(TestsUtils.txn('A', 'B', blocknumber))
+            commit()
+
+        full = self.nodes[0].history('A')
+        self.assertTrue(full == [[1, 10000], [2, -2], [3, -3], [4, -4], [5, -5], [6, -6]])
+        self.assertTrue(self.nodes[0].history_page('A', from_block=3, to_block=5) == {'history': [[3, -3], [4, -4], [5, -5]], 'next': None})
+        self.assertTrue(self.nodes[0].history_page('404', limit=2) == {'history': [], 'next': None})
+
+        pages = []
+        page = self.nodes[1].history_page('A', from_block=2, limit=2)
+        pages.append(page['history'])
+        while page['next'] is not None:
+            page = self.nodes[1].history_page('A', from_block=2, limit=2, cursor=page['next'])
+            pages.append(page['history'])
+        self.assertTrue(pages == [[[2, -2], [3, -3]], [[4, -4], [5, -5]], [[6, -6]]])
+
+    def test_h_balance_at_height(self):
+        self.nodes[0].genesis()
+        stagger()
+        commit()  # 0
+
+        self.nodes[1].send_txn(TestsUtils.txn('A', 'B', 5000))
+        commit()  # 1
+        commit()  # 2
+        self.nodes[0].send_txn(TestsUtils.txn('B', 'C', 1500))
+        self.nodes[0].send_txn(TestsUtils.txn('B', 'A', 500))
+        commit()  # 0
+
+        for node in self.nodes:
+            self.assertTrue([node.balance('A', n) for n in range(0, 6)] == [0, 10000, 5000, 5000, 5500, 5500])
+            self.assertTrue([node.balance('B', n) for n in range(0, 6)] == [0, 0, 5000, 5000, 3000, 3000])
+            self.assertTrue(node.balance('C') == 1500)
+            self.assertTrue(node.balance('404') == 0)
+
+
+class Tests6Proofs(unittest.TestCase):
+    def setUp(self):
+        self.nodes = []
+        for port in server_ports:
+            self.nodes.append(ServerProcess(port))
+        for node in self.nodes:
+            node.restart(BLOCK_COMMIT_TIME)
+        self.alive()
+
+    def tearDown(self):
+        self.alive()
+        for node in self.nodes:
+            node.kill_if_running()
+
+    def alive(self):
+        for node in self.nodes:
+            self.assertTrue(node.check_process_alive())
+            self.assertTrue(node.ping())
+
+    def test_a_inclusion_proof(self):
+        from blockchain import verify_inclusion_proof
+
+        self.nodes[0].genesis()
+        stagger()
+        commit()  # 0
+
+        txns = [TestsUtils.txn('A', 'B', 100 + i) for i in range(5)]
+        for txn in txns:
+            self.nodes[1].send_txn(txn)
+        pending = TestsUtils.txn('C', 'D', 1)
+        self.nodes[1].send_txn(pending)
+        commit()  # 1
+
+        for node in self.nodes:
+            for txn in txns:
+                proof = node.proof(TestsUtils.txid(txn))
+                self.assertTrue(proof is not None)
+                self.assertTrue(proof['transaction'] == txn)
+                self.assertTrue(proof['header']['number'] == 2)
+                self.assertTrue(verify_inclusion_proof(proof))
+
+            proof['transaction'] = TestsUtils.txn('A', 'B', 1000000)
+            self.assertFalse(verify_inclusion_proof(proof))
+            self.assertTrue(node.proof(TestsUtils.txid(pending)) is None)
+
+        # malformed proofs are not valid either
+        proof = self.nodes[0].proof(TestsUtils.txid(txns[0]))
+        for key, value in [('path', ['zz']), ('position', 'x'), ('position', None), ('transaction', {}), ('header', [])]:
+            self.assertFalse(verify_inclusion_proof(dict(proof, **{key: value})))
+        for key, value in [('version', '3'), ('txn_count', -1), ('merkle_root', 'zz')]:
+            self.assertFalse(verify_inclusion_proof(dict(proof, header=dict(proof['header'], **{key: value}))))
+        self.assertFalse(verify_inclusion_proof(dict(proof, header={})))
+        self.assertFalse(verify_inclusion_proof(None))
+
+
+
+class Tests7Export(unittest.TestCase):
+    def setUp(self):
+        self.nodes = []
+        for port in server_ports:
+            self.nodes.append(ServerProcess(port))
+        for node in self.nodes:
+            node.restart(BLOCK_COMMIT_TIME)
+        self.alive()
+
+    def tearDown(self):
+        self.alive()
+        for node in self.nodes:
+            node.kill_if_running()
+
+    def alive(self):
+        for node in self.nodes:
+            self.assertTrue(node.check_process_alive())
+            self.assertTrue(node.ping())
+
+    def test_a_export_matches_dump(self):
+        self.nodes[0].genesis()
+        stagger()
+        commit()  # 0
+
+        for blocknumber in range(2, 5):
+            self.nodes[(blocknumber - 1) % len(self.nodes)].send_txn(TestsUtils.txn('A', 'B', blocknumber))
+            commit()
+        self.nodes[1].send_txn(TestsUtils.txn('C', 'D', 1))
+        self.nodes[1].send_txn(TestsUtils.txn('B', 'D', 1))
+
+        node = self.nodes[1]
+        dump = node.dump()
+        self.assertTrue(node.get_json('/blocks') == {'blocks': dump['chain'], 'next': None})
+        self.assertTrue(node.get_json('/state') == dump['state'])
+        self.assertTrue(node.get_json('/mempool') == dump['pending_transactions'])
+        page = node.get_json('/mempool', limit=1)
+        self.assertTrue(page['pending_transactions'] == dump['pending_transactions'][:1])
+        # the cursor is a key: a transaction added in front of it does not shift the next page
+        node.send_txn(TestsUtils.txn('A', 'A', 1))
+        page = node.get_json('/mempool', limit=1, cursor=page['next'])
+        self.assertTrue(page == {'pending_transactions': dump['pending_transactions'][1:], 'next': None})
+
+        pages = []
+        page = node.get_json('/blocks', limit=3)
+        pages.append(page['blocks'])
+        while page['next'] is not None:
+            page = node.get_json('/blocks', limit=3, **{'from': page['next']})
+            pages.append(page['blocks'])
+        self.assertTrue([len(blocks) for blocks in pages] == [3, 1])
+        self.assertTrue(sum(pages, []) == dump['chain'])
+
+        self.assertTrue(node.blocks_ndjson() == (dump['chain'], None))
+        self.assertTrue(node.blocks_ndjson(to=3, limit=2) == (dump['chain'][:2], '3'))
+
+    def test_b_point_lookups(self):
+        self.nodes[0].genesis()
+        stagger()
+        commit()  # 0
+
+        committed = TestsUtils.txn('A', 'B', 7)
+        self.nodes[1].send_txn(committed)
+        commit()  # 1
+        pending = TestsUtils.txn('C', 'D', 1)
+        self.nodes[2].send_txn(pending)
+
+        node = self.nodes[2]
+        chain = node.dump()['chain']
+        for block in chain:
+            self.assertTrue(node.lookup('/block/%d' % block['number']) == block)
+            self.assertTrue(node.lookup('/block/hash/%s' % block['hash']) == block)
+        self.assertTrue(node.lookup('/block/%d' % (len(chain) + 1)) is None)
+        self.assertTrue(node.lookup('/block/hash/0xfeedcafe') is None)
+
+        self.assertTrue(node.lookup('/tx/%s' % TestsUtils.txid(committed)) == {
+            'txid': TestsUtils.txid(committed), 'transaction': committed, 'blocks': [[2, chain[1]['hash'], 0]], 'pending': 0})
+        self.assertTrue(node.lookup('/tx/%s' % TestsUtils.txid(pending))['pending'] == 1)
+        self.assertTrue(node.lookup('/tx/404') is None)
+
+
+
+class Tests8Sync(unittest.TestCase):
+    def setUp(self):
+        self.nodes = []
+        for port in server_ports:
+            self.nodes.append(ServerProcess(port))
+        for node in self.nodes:
+            node.restart(BLOCK_COMMIT_TIME)
+        self.alive()
+
+    def tearDown(self):
+        self.alive()
+        for node in self.nodes:
+            node.kill_if_running()
+
+    def alive(self):
+        for node in self.nodes:
+            self.assertTrue(node.check_process_alive())
+            self.assertTrue(node.ping())
+
+    def test_a_restarted_node_catches_up(self):
+        self.nodes[0].genesis()
+        stagger()
+        commit()  # 0
+
+        # the last node comes back with an empty chain, it missed the genesis block
+        self.nodes[2].kill_if_running()
+        self.nodes[2].instance = None
+        self.nodes[2].restart(BLOCK_COMMIT_TIME)
+        self.nodes[1].send_txn(TestsUtils.txn('A', 'B', 10))
+
+        commit()  # 1: the block is ahead of its chain, it fetches both blocks from the others
+        commit()  # 2: and proposes its block on time
+
+        dumps = [node.dump() for node in self.nodes]
+        self.assertTrue(len(dumps[2]['chain']) == 3)
+        self.assertTrue(dumps[2]['chain'][2]['miner'] == server_ports[2])
+        TestsUtils.checkChainEqualForAll(self, dumps[0]['chain'], dumps[1]['chain'], dumps[2]['chain'])
+        TestsUtils.checkStateEqualForAll(self, dumps[0]['state'], dumps[1]['state'], dumps[2]['state'])
+        self.assertTrue(dumps[2]['state']['B'] == 10)
+
+    def test_b_out_of_order_blocks(self):
+        block1 = TestsUtils.block(1, [], '0xfeedcafe', server_ports[0])
+        block2 = TestsUtils.block(2, [TestsUtils.txn('A', 'B', 100)], block1['hash'], server_ports[1])
+        block3 = TestsUtils.block(3, [TestsUtils.txn('B', 'C', 40)], block2['hash'], server_ports[2])
+        self.assertTrue(self.nodes[0].send_block(block1))
+
+        # held back until block 2 arrives, then committed after it
+        self.assertFalse(self.nodes[0].send_block(block3))
+        self.assertTrue(len(self.nodes[0].dump()['chain']) == 1)
+        self.assertTrue(self.nodes[0].send_block(block2))
+
+        dump = self.nodes[0].dump()
+        self.assertTrue([block['hash'] for block in dump['chain']] == [block1['hash'], block2['hash'], block3['hash']])
+        self.assertTrue(dump['state'] == {'A': 9900, 'B': 60, 'C': 40})
+
+
+class Tests9Storage(unittest.TestCase):
+    def setUp(self):
+        self.nodes = []
+        self.datadirs = []
+        for port in server_ports:
+            self.nodes.append(ServerProcess(port))
+            self.datadirs.append(tempfile.mkdtemp(prefix='p2b-%d-' % port))
+        for node, datadir in zip(self.nodes, self.datadirs):
+            node.restart(BLOCK_COMMIT_TIME, self.flags(datadir))
+        self.alive()
+
+    def tearDown(self):
+        self.alive()
+        for node in self.nodes:
+            node.kill_if_running()
+        for datadir in self.datadirs:
+            shutil.rmtree(datadir, ignore_errors=True)
+
+    def alive(self):
+        for node in self.nodes:
+            self.assertTrue(node.check_process_alive())
+            self.assertTrue(node.ping())
+
+    # a state snapshot after every block
+    def flags(self, datadir):
+        return ['--datadir', datadir, '--snapshot-blocks', '1']
+
+    def crash_and_restart(self, i):
+        self.nodes[i].kill_if_running()
+        self.nodes[i].instance = None
+        self.nodes[i].restart(BLOCK_COMMIT_TIME, self.flags(self.datadirs[i]))
+
+    def two_blocks(self):
+        self.nodes[0].genesis()
+        stagger()
+        commit()  # 0
+        self.nodes[1].send_txn(TestsUtils.txn('A', 'B', 10))
+        commit()  # 1
+        dump = self.nodes[2].dump()
+        self.assertTrue(len(dump['chain']) == 2)
+        return dump
+
+    def test_a_restart_recovers_the_chain(self):
+        before = self.two_blocks()
+        self.crash_and_restart(2)
+
+        after = self.nodes[2].dump()
+        self.assertTrue(after['chain'] == before['chain'])
+        self.assertTrue(after['state'] == before['state'] == {'A': 9990, 'B': 10})
+
+    def test_b_torn_tail_is_cut_off(self):
+        before = self.two_blocks()
+        self.nodes[2].kill_if_running()
+        # a record cut short by the crash
+        segment = os.path.join(self.datadirs[2], sorted(os.listdir(self.datadirs[2]))[-1])
+        with open(segment, 'ab') as f:
+            f.write(b'\x40\x00\x00\x00\x00\x00\x00\x00{"number": 3')
+        self.crash_and_restart(2)
+
+        after = self.nodes[2].dump()
+        self.assertTrue(after['chain'] == before['chain'])
+        self.assertTrue(after['state'] == before['state'])
+
+        # the log takes new blocks after the cut
+        block = TestsUtils.block(3, [TestsUtils.txn('B', 'C', 4)], before['chain'][-1]['hash'], server_ports[2])
+        self.assertTrue(self.nodes[2].send_block(block))
+        self.crash_and_restart(2)
+        after = self.nodes[2].dump()
+        self.assertTrue(len(after['chain']) == 3)
+        self.assertTrue(after['state'] == {'A': 9990, 'B': 6, 'C': 4})
+
+    def test_c_restart_loads_the_newest_snapshot(self):
+        from storage import SnapshotStore
+        before = self.two_blocks()
+        self.nodes[2].kill_if_running()
+        snapshots = SnapshotStore(self.datadirs[2])
+        newest = next(snapshots.load())
+        self.assertTrue(newest['height'] == 2 and newest['hash'] == before['chain'][1]['hash'])
+
+        # marked snapshots, to tell a loaded snapshot apart from a replay of the log
+        older = {'account': [['A', 10000], ['marker', 1]], 'history': [['A', [[1, 10000]]], ['marker', [[1, 1]]]]}
+        snapshots.write(1, before['chain'][0]['hash'], older)
+        newest['data']['account'].append(['marker', 2])
+        newest['data']['history'].append(['marker', [[2, 2]]])
+        snapshots.write(2, newest['hash'], newest['data'])
+        self.crash_and_restart(2)
+        self.assertTrue(self.nodes[2].dump()['state'] == {'A': 9990, 'B': 10, 'marker': 2})
+
+        # a snapshot that doesn't match the log is skipped: the older one is loaded and block 2 replayed on it
+        snapshots.write(2, '0xdifferent', newest['data'])
+        self.crash_and_restart(2)
+        self.assertTrue(self.nodes[2].dump()['state'] == {'A': 9990, 'B': 10, 'marker': 1})
+
+
+
+class Tests10Relay(unittest.TestCase):
+    def setUp(self):
+        self.nodes = []
+        for port in server_ports:
+            self.nodes.append(ServerProcess(port))
+        for node in self.nodes:
+            node.restart(BLOCK_COMMIT_TIME, ['--relay', '2'])
+        self.alive()
+
+    def tearDown(self):
+        self.alive()
+        for node in self.nodes:
+            node.kill_if_running()
+
+    def alive(self):
+        for node in self.nodes:
+            self.assertTrue(node.check_process_alive())
+            self.assertTrue(node.ping())
+
+    def test_a_identical_payments_all_commit(self):
+        self.nodes[0].genesis()
+        stagger()
+
+        payments = []
+        for i in range(30):
+            payments.append(TestsUtils.txn('A', 'R%d' % (i // 3), 1))
+            self.nodes[i % 3].send_txn(payments[-1])
+            time.sleep(0.1)  # spread over blocks, some copies are relayed after another one committed
+        for _ in range(2):
+            payments.append(TestsUtils.txn('A', 'S', 1))
+            self.nodes[0].send_txn(payments[-1])
+        commit()
+        commit()
+        commit()
+
+        TestsUtils.checkAllCommitted(self, self.nodes, payments)
+        self.assertTrue(self.nodes[0].dump()['state']['A'] == 10000 - len(payments))
+
+
+class Tests11Pipeline(unittest.TestCase):
+    def setUp(self):
+        self.nodes = []
+        for port in server_ports:
+            self.nodes.append(ServerProcess(port))
+        for node in self.nodes:
+            node.restart(BLOCK_COMMIT_TIME, ['--pipeline-depth', '2'])
+        self.alive()
+
+    def tearDown(self):
+        self.alive()
+        for node in self.nodes:
+            node.kill_if_running()
+
+    def alive(self):
+        for node in self.nodes:
+            self.assertTrue(node.check_process_alive())
+            self.assertTrue(node.ping())
+
+    def test_a_pipelined_blocks_commit_everything(self):
+        self.nodes[0].genesis()
+        stagger()
+
+        payments = []
+        for i in range(45):
+            # the later payments of each recipient spend what earlier blocks paid to it
+            if i < 15:
+                payments.append(TestsUtils.txn('A', 'B%d' % (i % 5), 10))
+            else:
+                payments.append(TestsUtils.txn('B%d' % (i % 5), 'C%d' % (i % 3), 1))
+            self.nodes[i % 3].send_txn(payments[-1])
+            time.sleep(0.1)  # spread over blocks, so blocks are proposed while earlier ones are in flight
+        for _ in range(4):
+            commit()
+
+        TestsUtils.checkAllCommitted(self, self.nodes, payments)
+        self.assertTrue(self.nodes[0].dump()['state']['A'] == 10000 - 150)
 
 if __name__ == '__main__':
     unittest.main(exit=False)
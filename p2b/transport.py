@@ -0,0 +1,109 @@
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class PeerStats(object):
+    def __init__(self):
+        self.delivered = 0  # requests that got a response
+        self.failed = 0  # requests that ran out of attempts
+        self.retries = 0  # extra attempts over all requests
+        self.total_latency = 0.0  # seconds, first attempt until response, of delivered requests
+        self.max_latency = 0.0
+        self.last_latency = None
+
+    def record(self, latency):
+        self.delivered += 1
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+        self.last_latency = latency
+
+    def encode(self):
+        return {
+            'delivered': self.delivered,
+            'failed': self.failed,
+            'retries': self.retries,
+            'mean_latency': self.total_latency / self.delivered if self.delivered else None,
+            'max_latency': self.max_latency,
+            'last_latency': self.last_latency,
+        }
+
+
+class PeerTransport(object):
+    # Talks to the other nodes: one pooled keep-alive session per peer, concurrent fan-out,
+    # per-request timeouts and a bounded number of retries. Keeps delivery latency stats per peer.
+    def __init__(self, timeout=2.0, retries=2, backoff=0.05, workers=8):
+        self.timeout = timeout  # seconds, per attempt
+        self.retries = retries  # extra attempts after a connection error, timeout or 5xx response
+        self.backoff = backoff  # seconds, doubled after every failed attempt
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.sessions = {}  # {peer: requests.Session}
+        self.stats = {}  # {peer: PeerStats}
+        self.fallback_peers = set()  # peers that answered 415 Unsupported Media Type to a request with a fallback
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='transport')
+
+    @staticmethod
+    def url(peer, path):
+        return f'http://localhost:{peer}{path}'
+
+    def session(self, peer):
+        with self.lock:
+            if peer not in self.sessions:
+                session = requests.Session()
+                session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=self.workers, max_retries=0))
+                self.sessions[peer] = session
+                self.stats[peer] = PeerStats()
+            return self.sessions[peer]
+
+    # POST to one peer. Returns the response, or None when every attempt failed.
+    # `fallback` returns the request arguments to use instead, if the peer does not support this content type.
+    def post(self, peer, path, fallback=None, **kwargs):
+        return self.request('POST', peer, path, fallback, **kwargs)
+
+    # GET from one peer. Returns the response, or None when every attempt failed.
+    def get(self, peer, path, **kwargs):
+        return self.request('GET', peer, path, **kwargs)
+
+    def request(self, method, peer, path, fallback=None, **kwargs):
+        if fallback is not None and peer in self.fallback_peers:
+            kwargs = fallback()
+            fallback = None
+        session = self.session(peer)
+        stats = self.stats[peer]
+        delay = self.backoff
+        started = time.monotonic()
+        for attempt in range(self.retries + 1):
+            if attempt > 0:
+                stats.retries += 1
+                time.sleep(delay)
+                delay *= 2
+            try:
+                response = session.request(method, self.url(peer, path), timeout=self.timeout, **kwargs)
+            except requests.RequestException as e:
+                logging.warning("[TRANSPORT] %s%s attempt %d failed: %s" % (peer, path, attempt + 1, e))
+                continue
+            if response.status_code == 415 and fallback is not None:
+                logging.info("[TRANSPORT] %s does not support %s, falling back" % (peer, kwargs.get('headers')))
+                self.fallback_peers.add(peer)
+                return self.request(method, peer, path, **fallback())
+            if response.status_code >= 500:
+                logging.warning("[TRANSPORT] %s%s attempt %d failed: %s" % (peer, path, attempt + 1, response.status_code))
+                continue
+            stats.record(time.monotonic() - started)
+            return response
+        stats.failed += 1
+        return None
+
+    # POST to all peers concurrently and wait for every delivery. Returns {peer: response or None}.
+    def broadcast(self, peers, path, **kwargs):
+        futures = {peer: self.pool.submit(self.post, peer, path, **kwargs) for peer in peers}
+        return {peer: future.result() for peer, future in futures.items()}
+
+    def encode_stats(self):
+        with self.lock:
+            return {str(peer): stats.encode() for peer, stats in self.stats.items()}